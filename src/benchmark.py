@@ -0,0 +1,276 @@
+import platform
+import subprocess
+import sys
+from argparse import ArgumentParser
+from json import dump
+from os import path, makedirs
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy
+import pandas
+from pandas import DataFrame, Series, Timestamp, concat, to_timedelta
+from src import logger, extractor, transformer, loader, dtypes
+from src.dates import format_dates, date_formats
+from src.format_plan import load_format
+
+# dynamically get path of script file, the sample format is in the data folder next to it
+default_format_file = path.join(path.dirname(path.dirname(path.abspath(__file__))), "data", "format.json")
+default_results_file = "benchmark.json"
+sinks = ["csv", "json", "xml", "sql"] + loader.columnar_targets
+
+first_names = ["Agnes", "Blake", "Corey", "Estella", "Jean", "Roxie", "Seth", "Sylvia", "Anna", "Lukas", "Marie",
+               "Jonas", "Lena", "Felix", "Sophie", "Paul"]
+last_names = ["Logan", "Foster", "Wells", "Willis", "Barber", "Stanley", "Byrd", "Wheeler", "Olson", "Müller",
+              "Schmidt", "Schneider", "Fischer", "Weber", "Meyer", "Wagner"]
+streets = ["Pagul Terrace", "Wium Point", "Zejlem River", "Uljev Loop", "Dotuf Parkway", "Booj Point", "Viksog Street",
+           "Vafi Manor", "Suit Park"]
+cities = ["Izuajzod", "Lizcarda", "Hegolsoc", "Ehezakizi", "Bufunedem", "Ikenobav", "Zubvarho", "Doppoaf", "Naicohi"]
+positions = ["mitglied", "vorstand", "schriftfuehrer", "kassenwart"]
+# gender spellings of the sample files, each file uses its own
+csv_genders = ["Male", "Female"]
+json_genders = ["m", "w", "d"]
+xml_genders = ["männlich", "weiblich", None]
+# values that do not match any data type of the format file
+dirty_numbers = ["x", "12a", "n/a", "-"]
+dirty_dates = ["31.02.1990", "1990-13-01", "unknown", "00.00.0000"]
+
+
+# replace a share of the values with values that fail validation
+def make_dirty(values, dirty_values, dirty_rate, rng) -> numpy.ndarray:
+    values = numpy.asarray(values, dtype=object).copy()
+    mask = rng.random(len(values)) < dirty_rate
+    values[mask] = rng.choice(dirty_values, mask.sum())
+    return values
+
+
+def choose(options, rows, rng) -> numpy.ndarray:
+    return numpy.asarray(options, dtype=object)[rng.integers(0, len(options), rows)]
+
+
+# club numbers with some members not being in a club
+def make_clubs(rows, rng) -> Series:
+    return Series(rng.integers(1, 40, rows), dtype="Int64").mask(Series(rng.random(rows) < 0.2))
+
+
+def make_birthdates(rows, rng) -> Series:
+    days = to_timedelta(rng.integers(0, 365 * 70, rows), unit="D")
+    return Series(Timestamp("1940-01-01") + days)
+
+
+# members in the layout of data/verein1.csv
+def make_csv_members(rows, first_id, dirty_rate, rng) -> DataFrame:
+    return DataFrame({
+        "id": make_dirty(numpy.arange(first_id, first_id + rows), dirty_numbers, dirty_rate, rng),
+        "vorname": choose(first_names, rows, rng),
+        "nachname": choose(last_names, rows, rng),
+        "aktiv": choose(["Y", "N", "1", "0"], rows, rng),
+        "geschlecht": choose(csv_genders, rows, rng),
+        "tel": choose(["(876) 483-7689", "(930) 772-9727", "(614) 848-3778"], rows, rng),
+        "email": choose(["uvehiw@lu.bd", "vivcuho@vov.gn", "bolhanza@pin.pr"], rows, rng),
+        "alter": make_dirty(rng.integers(16, 90, rows), dirty_numbers, dirty_rate, rng),
+        "strasse": choose(streets, rows, rng),
+        "hausnr": make_dirty(rng.integers(1, 200, rows), dirty_numbers, dirty_rate, rng),
+        "stadt": choose(cities, rows, rng),
+        "plz": rng.integers(1000, 99999, rows),
+        "verein1": make_clubs(rows, rng),
+        "verein2": make_clubs(rows, rng),
+        "verein3": make_clubs(rows, rng),
+    })
+
+
+# members in the layout of data/verein2.json
+def make_json_members(rows, first_id, dirty_rate, rng) -> DataFrame:
+    return DataFrame({
+        "nr": make_dirty(numpy.arange(first_id, first_id + rows), dirty_numbers, dirty_rate, rng),
+        "name": choose(first_names, rows, rng) + " " + choose(last_names, rows, rng),
+        "geschlecht": choose(json_genders, rows, rng),
+        "aktivesMitglied": choose(["j", "n"], rows, rng),
+        "geburstdatum": make_dirty(format_dates(make_birthdates(rows, rng), date_formats[("DMY", ".")]), dirty_dates,
+                                   dirty_rate, rng),
+        "email": choose(["amzernar@okiige.es", "mitnokfez@taj.jo", "wod@hugode.ga"], rows, rng),
+        "str": choose(streets, rows, rng),
+        "haus": make_dirty(rng.integers(1, 200, rows), dirty_numbers, dirty_rate, rng),
+        "stadt": choose(cities, rows, rng),
+        "plz": rng.integers(1000, 99999, rows).astype(str),
+        "mitgliedVereinA": make_clubs(rows, rng),
+        "mitgliedVereinB": make_clubs(rows, rng),
+    })
+
+
+# members in the layout of data/verein3.xml
+def make_xml_members(rows, first_id, dirty_rate, rng) -> DataFrame:
+    names = choose(first_names, rows, rng) + " " + choose(last_names, rows, rng)
+    return DataFrame({
+        "mitglnr": make_dirty(numpy.arange(first_id, first_id + rows), dirty_numbers, dirty_rate, rng),
+        "name": names,
+        "geschlecht": choose(xml_genders, rows, rng),
+        "geburtstag": make_dirty(format_dates(make_birthdates(rows, rng), date_formats[("YMD", "-")]), dirty_dates,
+                                 dirty_rate, rng),
+        "adresse1": choose(streets, rows, rng),
+        "adresse2": make_dirty(rng.integers(1, 200, rows), dirty_numbers, dirty_rate, rng),
+        "adresse3": choose(cities, rows, rng),
+        "adresse4": rng.integers(1000, 99999, rows),
+        "vereinsnr": rng.integers(1, 40, rows),
+        "position": choose(positions, rows, rng),
+        "name_kopie": names,
+    })
+
+
+# write one csv, json and xml file in the layouts of the sample files, the rows are split evenly between them
+# return the paths of the written files
+def generate_data(folder, rows, dirty_rate=0.01, seed=0) -> list[str]:
+    rng = numpy.random.default_rng(seed)
+    makedirs(folder, exist_ok=True)
+    file_rows = [rows // 3 + (1 if i < rows % 3 else 0) for i in range(3)]
+    first_ids = [1, 1 + file_rows[0], 1 + file_rows[0] + file_rows[1]]
+
+    csv_path = path.join(folder, "members.csv")
+    make_csv_members(file_rows[0], first_ids[0], dirty_rate, rng).to_csv(csv_path, sep=';', index=False)
+    json_path = path.join(folder, "members.json")
+    make_json_members(file_rows[1], first_ids[1], dirty_rate, rng).to_json(json_path, orient="records")
+    xml_path = path.join(folder, "members.xml")
+    make_xml_members(file_rows[2], first_ids[2], dirty_rate, rng).to_xml(xml_path, index=False,
+                                                                         root_name="vereinsverwaltung",
+                                                                         row_name="mitglied")
+    return [csv_path, json_path, xml_path]
+
+
+def record_stage(results, name, rows, seconds):
+    results[name] = {"seconds": round(seconds, 4), "rows": rows, "rows_per_second": round(rows / max(seconds, 1e-9))}
+    logger.log(f"Benchmark stage {name}: {seconds:.3f}s for {rows} rows", True)
+
+
+# run function and store its duration and throughput under the name of the stage
+def time_stage(results, name, rows, function, *arguments):
+    start = perf_counter()
+    result = function(*arguments)
+    record_stage(results, name, rows, perf_counter() - start)
+    return result
+
+
+def read_files(folder, files, column_types) -> list[tuple[str, DataFrame]]:
+    frames = []
+    for file in files:
+        df = extractor.extract_file(folder, file, column_types, "fail", validate=False)[0]
+        frames.append((file, df))
+    return frames
+
+
+def validate_files(frames, column_types, on_error) -> DataFrame:
+    return concat([extractor.validate_data_types(df, file, column_types, on_error) for file, df in frames],
+                  ignore_index=True)
+
+
+def save_to_sink(frame, targets, sink, folder):
+    if sink == "sql":
+        return loader.save_to_sql(frame, loader.get_database_url(path.join(folder, "out.db")),
+                                  ("members", "replace", None))
+    return loader.save(frame, targets, sink, path.join(folder, f"out.{sink}"))
+
+
+# commit the benchmark runs on, so results of different commits can be compared
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=path.dirname(path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# time every stage on its own, each stage gets the result of the stage before
+# return the results, including the environment they were measured in
+def run_benchmark(folder, format_file, on_error="null", benchmark_sinks=None) -> dict:
+    plan = load_format(format_file)
+    files = extractor.list_source_files(folder)
+    stages = {}
+
+    # the row count is only known after reading
+    start = perf_counter()
+    frames = read_files(folder, files, plan.read_column_types)
+    source_rows = sum(len(df) for file, df in frames)
+    record_stage(stages, "extract", source_rows, perf_counter() - start)
+    extracted_frame = time_stage(stages, "validate_data_types", source_rows, validate_files, frames,
+                                 plan.read_column_types, on_error)
+    transformed_frame = time_stage(stages, "transform", len(extracted_frame), transformer.transform_columns,
+                                   extracted_frame, plan)
+    target_frame = time_stage(stages, "apply_target_dtypes", len(transformed_frame), dtypes.apply_target_dtypes,
+                              transformed_frame, plan.targets)
+    target_frame = time_stage(stages, "postprocess_frame", len(target_frame), transformer.postprocess_frame,
+                              target_frame, plan.constraints)
+
+    # the saved targets are only written to be timed
+    available_sinks = loader.get_target_formats()
+    with TemporaryDirectory(prefix="etl_benchmark_", ignore_cleanup_errors=True) as output_folder:
+        for sink in benchmark_sinks or sinks:
+            if sink not in available_sinks:
+                logger.log(f"Skipping sink {sink}, it is not available.", True, logger.WARNING)
+                continue
+            time_stage(stages, f"load_{sink}", len(target_frame), save_to_sink, target_frame, plan.targets, sink,
+                       output_folder)
+
+    return {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "pandas": pandas.__version__,
+        "platform": platform.platform(),
+        "files": files,
+        "source_rows": source_rows,
+        "target_rows": len(target_frame),
+        "on_error": on_error,
+        "stages": stages,
+    }
+
+
+def parse_arguments(arguments=None):
+    parser = ArgumentParser(description="Generate synthetic member files and time every stage of the ETL process.")
+    parser.add_argument("--rows", type=int, default=100000, help="rows to generate, split between the files "
+                                                                 "(default: 100000)")
+    parser.add_argument("--dirty-rate", type=float, default=0.01,
+                        help="share of numbers and dates that do not match their data type (default: 0.01)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated data (default: 0)")
+    parser.add_argument("--input", help="benchmark the files in this folder instead of generating data")
+    parser.add_argument("--data-folder", help="folder the generated files are written to and kept in "
+                             "(default: a temporary folder that is deleted afterwards)")
+    parser.add_argument("--format", default=default_format_file, help="format file (default: data/format.json)")
+    parser.add_argument("--on-error", choices=["drop", "null", "fail"], default="null",
+                        help="how invalid values are handled during validation (default: null)")
+    parser.add_argument("--sinks", nargs="+", choices=sinks, default=sinks, help="targets to time (default: all)")
+    parser.add_argument("--output", default=default_results_file,
+                        help=f"json file the results are written to (default: {default_results_file})")
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None) -> int:
+    arguments = parse_arguments(arguments)
+    # values of every row are only logged at DEBUG level, which would distort the measurement
+    logger.init_logger(logger.INFO)
+
+    folder = arguments.input
+    generate_seconds = None
+    # generated files are only kept if --data-folder is given
+    temporary_folder = None
+    if folder is None:
+        if arguments.data_folder is None:
+            temporary_folder = TemporaryDirectory(prefix="etl_benchmark_data_", ignore_cleanup_errors=True)
+        folder = arguments.data_folder or temporary_folder.name
+        start = perf_counter()
+        generate_data(folder, arguments.rows, arguments.dirty_rate, arguments.seed)
+        generate_seconds = round(perf_counter() - start, 4)
+        logger.log(f"Generated {arguments.rows} rows in {folder}", True)
+
+    try:
+        results = run_benchmark(folder, arguments.format, arguments.on_error, arguments.sinks)
+    finally:
+        if temporary_folder is not None:
+            temporary_folder.cleanup()
+    results.update(data_folder=None if temporary_folder else folder,
+                   dirty_rate=None if arguments.input else arguments.dirty_rate, generate_seconds=generate_seconds)
+    with open(arguments.output, 'w', encoding='utf-8') as f:
+        dump(results, f, indent=2)
+    logger.log(f"Benchmark results saved to {arguments.output}", True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
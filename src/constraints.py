@@ -0,0 +1,144 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from os import path
+from pandas import DataFrame, Series, Timestamp, to_numeric
+from src import logger, metrics
+from src.dates import output_date_format
+
+# tags restricting the values of a target column, e.g. 'int§REQUIRED§UNIQUE§MIN:0', checked in this order
+constraint_names = ["REQUIRED", "MIN", "MAX", "PATTERN", "UNIQUE"]
+# tags that need an argument after a colon
+argument_constraints = ["MIN", "MAX", "PATTERN"]
+
+# file rows violating a constraint are written to, None to only count them
+rejects_file_path = None
+# keys of UNIQUE columns seen in earlier chunks of the run, None if only the current frame is checked
+seen_keys = None
+
+
+@dataclass(frozen=True)
+class Constraint:
+    name: str
+    column: str
+    # number or date for MIN and MAX, compiled regular expression for PATTERN
+    argument: object = None
+
+    def __str__(self):
+        return f"{self.name}({self.column})"
+
+
+# 'MIN:0' for an int column > Constraint('MIN', column, 0.0), None if the tag is invalid
+def compile_constraint(column, column_type, tag, date_types, errors) -> Constraint | None:
+    name, separator, argument = tag.partition(":")
+    if name not in constraint_names:
+        errors.append(f"Unknown tag '§{tag}' for target column {column}.")
+        return None
+    if (name in argument_constraints) != bool(separator):
+        errors.append(f"Tag '§{name}' of target column {column} " +
+                      ("needs an argument, e.g. '§MIN:0'." if name in argument_constraints else "takes no argument."))
+        return None
+
+    try:
+        if name in ["MIN", "MAX"]:
+            if column_type in ["int", "float"]:
+                return Constraint(name, column, float(argument))
+            elif column_type in date_types:
+                return Constraint(name, column, Timestamp(datetime.strptime(argument, output_date_format)))
+            errors.append(f"Tag '§{name}' of target column {column} needs a number or date column.")
+            return None
+        elif name == "PATTERN":
+            return Constraint(name, column, re.compile(argument))
+    except (ValueError, re.error) as e:
+        errors.append(f"Invalid argument for tag '§{name}' of target column {column}: {e}")
+        return None
+    return Constraint(name, column)
+
+
+# start a new rejects file, and remember keys of UNIQUE columns between frames if the data comes in chunks
+def start_run(rejects_path=None, remember_keys=False):
+    global rejects_file_path, seen_keys
+    rejects_file_path = rejects_path
+    seen_keys = {} if remember_keys else None
+    if rejects_path is not None:
+        open(rejects_path, 'w').close()
+
+
+# rows violating a constraint that applies to single values, missing values only violate REQUIRED
+def find_violations(frame: DataFrame, constraint: Constraint) -> Series:
+    values = frame[constraint.column]
+    if constraint.name == "MIN":
+        return values < constraint.argument if values.dtype.kind == "M" else to_numeric(values) < constraint.argument
+    elif constraint.name == "MAX":
+        return values > constraint.argument if values.dtype.kind == "M" else to_numeric(values) > constraint.argument
+    elif constraint.name == "PATTERN":
+        present = values.notna()
+        valid = values[present].astype(str).str.fullmatch(constraint.argument)
+        return present & ~valid.reindex(values.index, fill_value=True).astype(bool)
+    return Series(False, index=frame.index)
+
+
+# later rows with a key that appeared before, in this frame or in earlier chunks
+def find_duplicates(frame: DataFrame, constraint: Constraint, rejected: Series) -> Series:
+    values = frame[constraint.column]
+    present = values.notna() & ~rejected
+    duplicated = values[present].duplicated(keep="first")
+    if seen_keys is not None:
+        keys = seen_keys.setdefault(constraint.column, set())
+        duplicated |= values[present].isin(keys)
+        keys.update(values[present][~duplicated])
+    return duplicated.reindex(frame.index, fill_value=False).astype(bool)
+
+
+def save_rejects(frame: DataFrame, violations: dict[Constraint, Series], rejected: Series):
+    labels = Series("", index=frame.index[rejected], dtype=object)
+    for constraint, mask in violations.items():
+        labels[mask[rejected]] += f"{constraint} "
+    rejects = frame[rejected].assign(violations=labels.str.strip())
+    # the header is only written to an empty file, so chunks and batches are appended below it
+    header = not path.exists(rejects_file_path) or path.getsize(rejects_file_path) == 0
+    rejects.to_csv(rejects_file_path, mode="a", header=header, index=False, sep=';', date_format=output_date_format)
+
+
+# drop rows violating any constraint, count the violations of each constraint
+# required columns are checked together with a single mask, unique keys are only checked on the remaining rows
+def apply_constraints(frame: DataFrame, constraints: list[Constraint]) -> DataFrame:
+    if not constraints or frame.empty:
+        return frame
+    violations = {}
+    required_columns = [constraint.column for constraint in constraints if constraint.name == "REQUIRED"]
+    if required_columns:
+        missing = frame[required_columns].isna()
+        rejected = ~frame[required_columns].notna().all(axis=1)
+        for constraint in constraints:
+            if constraint.name == "REQUIRED":
+                violations[constraint] = missing[constraint.column]
+    else:
+        rejected = Series(False, index=frame.index)
+
+    for constraint in constraints:
+        if constraint.name in ["MIN", "MAX", "PATTERN"]:
+            violations[constraint] = find_violations(frame, constraint).fillna(False).astype(bool)
+            rejected |= violations[constraint]
+    for constraint in constraints:
+        if constraint.name == "UNIQUE":
+            violations[constraint] = find_duplicates(frame, constraint, rejected)
+            rejected |= violations[constraint]
+
+    for constraint, mask in violations.items():
+        count = int(mask.sum())
+        if count:
+            metrics.count(f"violations_{constraint.name.lower()}", count)
+            logger.log(f"{count} rows violate {constraint}.", False)
+    if not rejected.any():
+        return frame
+
+    if logger.is_enabled(logger.DEBUG):
+        for constraint, mask in violations.items():
+            for index in frame.index[mask]:
+                logger.log(f"Discarding row {index} because it violates {constraint}.", False, logger.DEBUG)
+    if rejects_file_path is not None:
+        save_rejects(frame, violations, rejected)
+    metrics.count("dropped_constraint_rows", int(rejected.sum()))
+    logger.log(f"Discarded {rejected.sum()} rows violating constraints of the target columns.", False)
+    return frame[~rejected]
@@ -0,0 +1,69 @@
+from numpy import append, datetime64, trunc
+from pandas import DataFrame, Series, Timestamp, factorize, to_datetime, to_numeric
+from pandas.api.types import is_datetime64_any_dtype
+
+# format of all dates in the transformed frame
+output_date_format = "%d-%m-%Y"
+# date formats by order and separator, e.g. ('DMY', '.') for the data type 'datetime_DMY_.'
+date_formats = {
+    ("DMY", "-"): "%d-%m-%Y",
+    ("DMY", "."): "%d.%m.%Y",
+    ("MDY", "-"): "%m-%d-%Y",
+    ("MDY", "."): "%m.%d.%Y",
+    ("YMD", "-"): "%Y-%m-%d",
+    ("YMD", "."): "%Y.%m.%d",
+}
+
+# date all ages and birthdates of a run are calculated against
+reference_date = None
+
+
+def get_reference_date() -> Timestamp:
+    global reference_date
+    if reference_date is None:
+        reference_date = Timestamp.today().normalize()
+    return reference_date
+
+
+# 'datetime_DMY_.' > ('DMY', '.'), None for other data types
+def get_date_format(data_type) -> tuple[str, str] | None:
+    parts = data_type.split("_") if isinstance(data_type, str) else []
+    if len(parts) == 3 and parts[0] == "datetime" and (parts[1], parts[2]) in date_formats:
+        return parts[1], parts[2]
+    return None
+
+
+# parse a column of dates, values that do not match the format become NaT
+# every distinct value is only parsed once, columns that are already parsed are returned as they are
+def parse_dates(values: Series, date_format: tuple[str, str] | str) -> Series:
+    if is_datetime64_any_dtype(values):
+        return values
+    codes, uniques = factorize(values)
+    strftime_format = date_formats[date_format] if isinstance(date_format, tuple) else date_format
+    parsed = to_datetime(Series(uniques, dtype=object), format=strftime_format, errors="coerce").to_numpy()
+    # code -1 marks missing values and picks the appended NaT
+    return Series(append(parsed, datetime64("NaT", "ns"))[codes], index=values.index)
+
+
+# format a column of parsed dates as text, every distinct date is only formatted once
+def format_dates(values: Series, strftime_format=output_date_format) -> Series:
+    codes, uniques = factorize(values)
+    formatted = Series(uniques).dt.strftime(strftime_format).to_numpy(dtype=object)
+    return Series(append(formatted, None)[codes], index=values.index, dtype=object)
+
+
+# full years between the dates and the reference date
+def calc_age(values: Series) -> Series:
+    today = get_reference_date()
+    before_birthday = (values.dt.month > today.month) | ((values.dt.month == today.month) & (values.dt.day > today.day))
+    ages = today.year - values.dt.year - before_birthday.astype(int)
+    return ages.astype("Int64").astype(object).where(values.notna(), None)
+
+
+# birthdates for the given ages, assuming the reference date is the birthday
+# every distinct age is only calculated once
+def calc_birthdate(values: Series) -> Series:
+    today = get_reference_date()
+    codes, years = factorize(today.year - trunc(to_numeric(values, errors="coerce")))
+    birthdates = to_datetime(DataFrame({"year": years, "month": today.month, "day": today.day}), errors="coerce")
+    return Series(append(birthdates.to_numpy(), datetime64("NaT", "ns"))[codes], index=values.index)
@@ -0,0 +1,100 @@
+from numpy import iinfo, int32
+from pandas import DataFrame, Series, CategoricalDtype, to_numeric
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_object_dtype
+from src import logger, metrics
+from src.dates import output_date_format, parse_dates, format_dates
+from src.format_plan import TargetColumn, date_types
+
+# text columns with at most this share of distinct values are stored as categories
+category_ratio = 0.5
+# target types that are not stored as text, all others are, e.g. str, gender or mail
+typed_types = ["int", "float", "bool"] + date_types
+
+boolean_values = {True: True, False: False, "1": True, "0": False}
+
+
+# whole numbers as nullable Int32, or Int64 if they do not fit
+def compact_int(values: Series) -> Series:
+    numbers = to_numeric(values, errors="coerce").round()
+    if numbers.notna().any() and (numbers.min() < iinfo(int32).min or numbers.max() > iinfo(int32).max):
+        return numbers.astype("Int64")
+    return numbers.astype("Int32")
+
+
+def compact_bool(values: Series) -> Series:
+    if is_bool_dtype(values):
+        return values.astype("boolean")
+    return values.map(boolean_values).astype("boolean")
+
+
+# repetitive text as category, everything else is kept as it is
+def compact_text(values: Series) -> Series:
+    if isinstance(values.dtype, CategoricalDtype) or not is_object_dtype(values):
+        return values
+    present = values.notna().sum()
+    if present and values.nunique() <= present * category_ratio:
+        return values.astype("category")
+    return values
+
+
+# convert a column to the most compact dtype for its data type
+# dates are expected as parsed dates or text in the output date format
+def compact_column(values: Series, data_type) -> Series:
+    if data_type == "int":
+        return compact_int(values)
+    elif data_type == "float":
+        return to_numeric(values, errors="coerce").astype("Float64")
+    elif data_type == "bool":
+        return compact_bool(values)
+    elif data_type in date_types:
+        return parse_dates(values, output_date_format)
+    return compact_text(values)
+
+
+# columns of validated source data, e.g. again after frames with different categories were combined
+def apply_source_dtypes(frame: DataFrame, column_types: dict[str, str]) -> DataFrame:
+    for column in frame.columns:
+        if column in column_types:
+            frame[column] = compact_column(frame[column], column_types[column])
+    return frame
+
+
+# columns of transformed data, text columns only hold text afterward
+def apply_target_dtypes(frame: DataFrame, targets: dict[str, TargetColumn]) -> DataFrame:
+    typed_frame = DataFrame(index=frame.index)
+    for column in frame.columns:
+        values = frame[column]
+        target_type = targets[column].type if column in targets else "str"
+        if target_type not in typed_types and is_object_dtype(values):
+            values = values.where(values.isna(), values.astype(str))
+        typed_frame[column] = compact_column(values, target_type)
+    return typed_frame
+
+
+# text formats get dates in the output date format and bools as 1 and 0, like the transformation used to produce them
+def to_text_columns(frame: DataFrame) -> DataFrame:
+    columns = {}
+    for column in frame.columns:
+        values = frame[column]
+        if is_datetime64_any_dtype(values):
+            columns[column] = format_dates(values)
+        elif values.dtype == "boolean":
+            columns[column] = values.map({True: "1", False: "0"}, na_action="ignore").astype(object)
+    return frame.assign(**columns) if columns else frame
+
+
+# memory of the frame and of the same frame with every column stored as python objects
+def get_memory_usage(frame: DataFrame) -> tuple[int, int]:
+    used = int(frame.memory_usage(deep=True, index=False).sum())
+    as_objects = sum(int(frame[column].astype(object).memory_usage(deep=True, index=False))
+                     for column in frame.columns)
+    return used, as_objects
+
+
+# log how much memory the compact dtypes save, e.g. report_memory(frame, "transformed")
+def report_memory(frame: DataFrame, name):
+    used, as_objects = get_memory_usage(frame)
+    metrics.count(f"{name}_memory_bytes", used)
+    metrics.count(f"{name}_object_memory_bytes", as_objects)
+    logger.log(f"Memory of {name} data: {used / 1024 ** 2:.2f}MiB instead of {as_objects / 1024 ** 2:.2f}MiB as "
+               f"objects ({(as_objects - used) / max(as_objects, 1) * 100:.0f}% less)", True)
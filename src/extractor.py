@@ -1,147 +1,405 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from json import load
 from os import path, listdir
-from pandas import isnull, DataFrame, to_datetime, read_csv, read_xml, read_json, concat
-from src import logger
+from time import perf_counter
+from pandas import DataFrame, Series, to_numeric, read_csv, read_json, concat
+from src import logger, dates, dtypes, metrics, xml_reader
 
+# how to handle values not matching their column type
+error_policies = ["interactive", "drop", "null", "fail"]
+# data types the csv parser reads as numbers, all others are read as text
+number_types = ["int", "float"]
 
-def validate_data_types(df: DataFrame, file_name, column_types):
+# dynamically get path of script file and place rejected values next to it
+rejects_file_path = path.join(path.dirname(path.abspath(__file__)), "rejects.csv")
+rejects_columns = ["file", "row", "column", "value", "expected_type"]
+
+bool_values = {
+    "true": True, "1": True, "1.0": True, "yes": True, "y": True, "ja": True, "j": True,
+    "false": False, "0": False, "0.0": False, "no": False, "n": False, "nein": False,
+}
+
+
+def init_rejects():
+    # create rejects file or clear content if exists
+    DataFrame(columns=rejects_columns).to_csv(rejects_file_path, index=False, sep=';')
+
+
+def save_rejects(rejects: list[tuple]):
+    if rejects:
+        DataFrame(rejects, columns=rejects_columns).to_csv(rejects_file_path, mode="a", header=False, index=False,
+                                                           sep=';')
+
+
+# convert a whole column to the expected type, values that do not fit become null
+# returns None if the type is unknown
+def convert_column(values: Series, expected_type) -> Series | None:
+    if expected_type == "int":
+        converted = to_numeric(values, errors="coerce")
+        return converted.where(converted % 1 == 0)
+    elif expected_type == "float":
+        return to_numeric(values, errors="coerce")
+    elif expected_type == "str":
+        return values
+    elif expected_type == "bool":
+        if values.dtype == bool:
+            return values
+        return values.astype(str).str.strip().str.lower().map(bool_values)
+    elif dates.get_date_format(expected_type) is not None:
+        return dates.parse_dates(values, dates.get_date_format(expected_type))
+    return None
+
+
+# '' and '  ' > True, other values > False
+def is_blank(values: Series) -> Series:
+    return values.astype(str).str.strip().eq("").astype(bool)
+
+
+def prompt_invalid_value(df: DataFrame, file_name, column, index, value, expected_type) -> bool:
+    # prompt user until the value is fixed, returns False if the row should be removed
+    while True:
+        # noinspection SpellCheckingInspection
+        user_input = input(
+            f"Error in file '{file_name}', column '{column}', row {index} with value '{value}'.\n"
+            f"Data type: {expected_type}\n"
+            "Would you like to [r]emove the row or [e]nter a new value?: "
+        ).strip().lower()
+        # remove row from table
+        if user_input == "r":
+            logger.log(f"Row {index} in file {file_name} removed by user.", False)
+            return False
+        # ask user for new value
+        elif user_input == "e":
+            value = input(f"Enter new value for column '{column}': ")
+            logger.log(f"Value '{value}' inserted into column {column} at row {index} in file {file_name} by user.",
+                       False)
+            if convert_column(Series([value]), expected_type).notna().all():
+                df.at[index, column] = value
+                return True
+            logger.log(
+                f"Value '{value}' in column {column} at row {index} in file {file_name} does not match expected type {expected_type}",
+                False)
+        else:
+            print("Invalid choice. Please enter 'r' to remove the row or 'e' to enter a new value.")
+
+
+# invalid values are appended to rejects if given, otherwise they are saved to the rejects file
+def validate_data_types(df: DataFrame, file_name, column_types, on_error="interactive", rejects=None) -> DataFrame:
+    save_to_file = rejects is None
+    if save_to_file:
+        rejects = []
+    rows_to_drop = set()
     for column, expected_type in column_types.items():
-        if column in df.columns:
-            for index, value in df[column].items():
-                # skip null values
-                if isnull(value):
-                    continue
-
-                # try converting each cell to value, on error > prompt user
-                while True:
-                    try:
-                        if expected_type == "int":
-                            df.at[index, column] = int(value)
-                        elif expected_type == "float":
-                            df.at[index, column] = float(value)
-                        elif expected_type == "str":
-                            df.at[index, column] = str(value)
-                        elif expected_type == "bool":
-                            df.at[index, column] = bool(value)
-                        elif expected_type == "datetime_YMD_.":
-                            df.at[index, column] = to_datetime(value, format="%Y.%m.%d")
-                        elif expected_type == "datetime_DMY_.":
-                            df.at[index, column] = to_datetime(value, format="%d.%m.%Y")
-                        elif expected_type == "datetime_MDY_.":
-                            df.at[index, column] = to_datetime(value, format="%m.%d.%Y")
-                        elif expected_type == "datetime_YMD_-":
-                            df.at[index, column] = to_datetime(value, format="%Y-%m-%d")
-                        elif expected_type == "datetime_DMY_-":
-                            df.at[index, column] = to_datetime(value, format="%d-%m-%Y")
-                        elif expected_type == "datetime_MDY_-":
-                            df.at[index, column] = to_datetime(value, format="%m-%d-%Y")
-                        else:
-                            logger.log(f"Unknown data type '{expected_type}' for column {column}.", True)
-                        # apply value, in case it was changed below
-                        df.at[index, column] = value
-                        break
-                    except ValueError:
-                        # log event
-                        logger.log(
-                            f"Value '{value}' in column {column} at row {index} in file {file_name} does not match expected type {expected_type}",
-                            False)
-                        # prompt user for action
-                        # noinspection SpellCheckingInspection
-                        user_input = input(
-                            f"Error in file '{file_name}', column '{column}', row {index} with value '{value}'.\n"
-                            f"Data type: {expected_type}\n"
-                            "Would you like to [r]emove the row or [e]nter a new value?: "
-                        ).strip().lower()
-                        # remove row from table
-                        if user_input == "r":
-                            df = df.drop(index)
-                            logger.log(f"Row {index} in file {file_name} removed by user.", False)
-                            break
-                        # ask user for new value
-                        elif user_input == "e":
-                            new_value = input(f"Enter new value for column '{column}': ")
-                            value = new_value
-                            logger.log(
-                                f"Value '{new_value}' inserted into column {column} at row {index} in file {file_name} by user.",
-                                False)
-                        else:
-                            print("Invalid choice. Please enter 'r' to remove the row or 'e' to enter a new value.")
-                            continue
+        if column not in df.columns:
+            continue
+
+        # convert the whole column at once, null values are skipped
+        converted = convert_column(df[column], expected_type)
+        if converted is None:
+            logger.log(f"Unknown data type '{expected_type}' for column {column}.", True)
+            continue
+        invalid = df[column].notna() & converted.isna()
+        # blank text is a missing value, e.g. an empty birth date in a json file, only values failing the conversion are checked
+        if invalid.any():
+            invalid &= ~is_blank(df.loc[invalid, column]).reindex(df.index, fill_value=False)
+        if not invalid.any():
+            # keep the converted values in a compact dtype, dates are not parsed again during the transformation
+            df[column] = dtypes.compact_column(converted, expected_type)
+            continue
+
+        logger.log(f"{invalid.sum()} values in column {column} in file {file_name} do not match expected type "
+                   f"{expected_type}", False)
+        debug = logger.is_enabled(logger.DEBUG)
+        for index, value in df.loc[invalid, column].items():
+            if debug:
+                logger.log(
+                    f"Value '{value}' in column {column} at row {index} in file {file_name} does not match expected type {expected_type}",
+                    False, logger.DEBUG)
+            rejects.append((file_name, index, column, value, expected_type))
+            # ask user what to do, skip rows the user already removed
+            if on_error == "interactive" and index not in rows_to_drop:
+                if not prompt_invalid_value(df, file_name, column, index, value, expected_type):
+                    rows_to_drop.add(index)
+
+        if on_error == "drop":
+            rows_to_drop.update(df.index[invalid])
+        elif on_error == "null":
+            logger.log(f"{invalid.sum()} invalid values in column {column} in file {file_name} set to null.", False)
+
+        # values entered by the user still have to be converted, all others are taken from the conversion
+        # invalid values are null in the conversion
+        if on_error == "interactive":
+            converted = convert_column(df[column], expected_type)
+        df[column] = dtypes.compact_column(converted, expected_type)
+
+    if save_to_file:
+        save_rejects(rejects)
+    if rejects and on_error == "fail":
+        raise ValueError(f"{len(rejects)} values in file {file_name} do not match their expected type.")
+
+    # drop selected rows, keeping the original order
+    if rows_to_drop:
+        df = df.drop([index for index in df.index if index in rows_to_drop])
+        logger.log(f"Removed {len(rows_to_drop)} rows with invalid values from file {file_name}.", False)
     return df
 
 
+# only the given columns are read, e.g. no columns the format discards
+# text and dates are read as text, so the parser does not have to guess them (and does not turn '01234' into 1234)
+def get_csv_options(column_types) -> dict:
+    if column_types is None:
+        return {}
+    return {
+        "usecols": lambda column: column in column_types,
+        "dtype": {column: str for column, column_type in column_types.items() if column_type not in number_types},
+    }
+
+
+# drop columns without a data type right after reading, for formats that can not skip them while parsing
+def select_columns(df: DataFrame, column_types) -> DataFrame:
+    if column_types is None:
+        return df
+    return df[[column for column in df.columns if column in column_types]]
+
+
+def read_csv_file(file_path, column_types=None) -> DataFrame:
+    return read_csv(file_path, sep=';', **get_csv_options(column_types))
+
+
+# a json array of records is turned into a frame directly, the values are checked by validate_data_types anyway
+# only keys with a data type become columns, in the order they first appear, other layouts are left to pandas
+def read_json_document(file_path, column_types=None) -> DataFrame:
+    with open(file_path, 'r', encoding='utf-8') as f:
+        records = load(f)
+    if isinstance(records, list) and all(isinstance(record, dict) for record in records):
+        if column_types is None:
+            return DataFrame(records)
+        keys = dict.fromkeys(key for record in records for key in record)
+        return DataFrame(records, columns=[key for key in keys if key in column_types])
+    return select_columns(read_json(file_path), column_types)
+
+
+def get_first_json_char(file_path) -> str:
+    with open(file_path, 'r', encoding='utf-8') as f:
+        first_char = f.read(1)
+        while first_char.isspace():
+            first_char = f.read(1)
+    return first_char
+
+
+# line-delimited json, e.g. written by the json target in streaming and watch mode, is tried first like in
+# read_json_chunks, so both modes read the same rows
+def read_json_file(file_path, column_types=None) -> DataFrame:
+    if get_first_json_char(file_path) != "[":
+        try:
+            return select_columns(read_json(file_path, lines=True), column_types)
+        except ValueError:
+            pass
+    return read_json_document(file_path, column_types)
+
+
+def read_csv_chunks(file_path, chunk_size, column_types=None):
+    return read_csv(file_path, sep=';', chunksize=chunk_size, **get_csv_options(column_types))
+
+
+def split_json_file(file_path, chunk_size, column_types=None):
+    df = read_json_document(file_path, column_types)
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size].copy()
+
+
+# yield the rows of a json file in frames of chunk_size rows
+# line-delimited json is streamed, a json array has to be read completely and is split afterward
+# other json, e.g. a single object spanning several lines, is read like in batch mode
+def read_json_chunks(file_path, chunk_size, column_types=None):
+    if get_first_json_char(file_path) == "[":
+        yield from split_json_file(file_path, chunk_size, column_types)
+        return
+    read_any = False
+    try:
+        with read_json(file_path, lines=True, chunksize=chunk_size) as reader:
+            for df in reader:
+                read_any = True
+                yield select_columns(df, column_types)
+    except ValueError:
+        # chunks already yielded cannot be taken back
+        if read_any:
+            raise
+        yield from split_json_file(file_path, chunk_size, column_types)
+
+
+# readers by file extension, as (read whole file, read file in chunks)
+# readers take the data types of the columns to read (e.g. FormatPlan.read_column_types), or None for all columns
+# files are processed in the order of this registry
+readers = {
+    ".csv": (read_csv_file, read_csv_chunks),
+    ".xml": (xml_reader.read_xml_file, xml_reader.read_xml_chunks),
+    ".json": (read_json_file, read_json_chunks),
+}
+
+
+def get_extension(file) -> str:
+    return path.splitext(file)[1].lower()
+
+
+# return names of all supported files in the folder, in the order they are processed
+def list_source_files(folder) -> list[str]:
+    extensions = list(readers.keys())
+    files = [file for file in listdir(folder) if get_extension(file) in readers]
+    return sorted(files, key=lambda file: (extensions.index(get_extension(file)), file))
+
+
+# read and validate a single file
+# return the frame (None if the file could not be read), source rows, source bytes, invalid values and seconds taken
+def extract_file(folder, file, column_types, on_error="interactive", validate=True) \
+        -> tuple[DataFrame | None, int, int, list[tuple], float]:
+    file_path = path.join(folder, file)
+    rejects = []
+    start = perf_counter()
+    try:
+        logger.log(f"Reading file {file}...", True)
+        # read file
+        df = readers[get_extension(file)][0](file_path, column_types)
+        # save statistics
+        source_rows = len(df)
+        source_bytes = path.getsize(file_path)
+        # validate data types
+        if validate:
+            df = validate_data_types(df, file, column_types, on_error, rejects)
+        return df, source_rows, source_bytes, rejects, perf_counter() - start
+    except Exception as e:
+        logger.log(f"Could not read file {file}: {e}", True, logger.ERROR)
+        if on_error == "fail":
+            raise
+        return None, 0, 0, rejects, perf_counter() - start
+    finally:
+        # worker processes exit without writing their buffered messages
+        logger.flush()
+
+
+# read and validate the given files, the rejects of each file are saved
+# with more than one worker, files are read and validated in parallel processes
+# return a list of frame (None if the file could not be read), source rows and source bytes in the order of the files
+def extract_files(folder, files, column_types, on_error="interactive", workers=1) \
+        -> list[tuple[DataFrame | None, int, int]]:
+    if workers > 1 and len(files) > 1:
+        # worker processes can not prompt the user, interactive validation happens afterward in this process
+        validate_in_worker = on_error != "interactive"
+        logger.log(f"Reading {len(files)} files with {workers} workers...", True)
+        # processes that are not forked do not inherit the row path
+        with ProcessPoolExecutor(max_workers=workers, initializer=xml_reader.set_row_path,
+                                 initargs=(xml_reader.row_path,)) as executor:
+            # map returns the results in the order of the files
+            results = list(executor.map(extract_file, repeat(folder), files, repeat(column_types), repeat(on_error),
+                                        repeat(validate_in_worker)))
+        if not validate_in_worker:
+            for i, (df, source_rows, source_bytes, rejects, seconds) in enumerate(results):
+                if df is not None:
+                    start = perf_counter()
+                    df = validate_data_types(df, files[i], column_types, on_error, rejects)
+                    results[i] = (df, source_rows, source_bytes, rejects, seconds + perf_counter() - start)
+    else:
+        results = [extract_file(folder, file, column_types, on_error) for file in files]
+
+    for file, (df, source_rows, source_bytes, rejects, seconds) in zip(files, results):
+        save_rejects(rejects)
+        record_file_metrics(file, df, source_rows, source_bytes, rejects, seconds)
+    return [(df, source_rows, source_bytes) for df, source_rows, source_bytes, rejects, seconds in results]
+
+
+# measurements of a file are recorded by the main process, worker processes can not report them
+def record_file_metrics(file, df, source_rows, source_bytes, rejects, seconds):
+    rows_out = 0 if df is None else len(df)
+    metrics.record_file(file, rows_in=source_rows, rows_out=rows_out, bytes=source_bytes, seconds=seconds,
+                        rejected_values=len(rejects), dropped_rows=source_rows - rows_out, failed=int(df is None))
+    metrics.count("rejected_values", len(rejects))
+    metrics.count("dropped_rows", source_rows - rows_out)
+
+
 # return combined data frame, total amount of columns in source data and combined size of source data
-def extract(folder, column_types) -> tuple[DataFrame, int, int]:
+def extract(folder, column_types, on_error="interactive", workers=1) -> tuple[DataFrame, int, int]:
     total_source_rows = 0
     total_source_bytes = 0
 
     # gather references to all found files
-    files = listdir(folder)
-    csv_collection = [file for file in files if file.endswith('.csv')]
-    xml_collection = [file for file in files if file.endswith('.xml')]
-    json_collection = [file for file in files if file.endswith('.json')]
+    files = list_source_files(folder)
 
     # do not continue if no files found
-    if not (csv_collection or xml_collection or json_collection):
+    if not files:
         logger.log("No CSV, XML, or JSON file in the specified folder.", False)
         raise ValueError("No CSV, XML, or JSON file in the specified folder.")
 
-    data_frames = []
-    for file in csv_collection:
-        file_path = path.join(folder, file)
-        try:
-            logger.log(f"Reading file {file}...", True)
-            # read file
-            df = read_csv(file_path, sep=';')
-            # save statistics
-            total_source_rows += len(df)
-            total_source_bytes += path.getsize(file_path)
-            # validate data types
-            df = validate_data_types(df, file, column_types)
-            # append content to combined frame
-            data_frames.append(df)
-        except Exception as e:
-            logger.log(f"Could not read file {file}:\n{e}", True)
+    # start a new rejects file for this run
+    init_rejects()
 
-    for file in xml_collection:
-        file_path = path.join(folder, file)
-        try:
-            logger.log(f"Reading file {file}...", True)
-            # read file
-            df = read_xml(file_path)
-            # save statistics
-            total_source_rows += len(df)
-            total_source_bytes += path.getsize(file_path)
-            # validate data types
-            df = validate_data_types(df, file, column_types)
-            # append content to combined frame
-            data_frames.append(df)
-        except Exception as e:
-            logger.log(f"Could not read file {file}: {e}", True)
+    with metrics.stage("extract") as rows:
+        results = extract_files(folder, files, column_types, on_error, workers)
 
-    # load all json files
-    for file in json_collection:
-        file_path = path.join(folder, file)
-        try:
-            logger.log(f"Reading file {file}...", True)
-            # read file
-            df = read_json(file_path)
-            # save statistics
-            total_source_rows += len(df)
-            total_source_bytes += path.getsize(file_path)
-            # validate data types
-            df = validate_data_types(df, file, column_types)
+        data_frames = []
+        for df, source_rows, source_bytes in results:
+            if df is None:
+                continue
+            total_source_rows += source_rows
+            total_source_bytes += source_bytes
             # append content to combined frame
             data_frames.append(df)
-        except Exception as e:
-            logger.log(f"Could not read file {file}: {e}", True)
+
+        rows["rows_in"] = total_source_rows
+        rows["rows_out"] = sum(len(df) for df in data_frames)
+        frame = concat(data_frames, ignore_index=True) if data_frames else None
+        if frame is not None:
+            # columns of files with different categories are combined as objects
+            frame = dtypes.apply_source_dtypes(frame, column_types)
 
     # check if data combination was successful
-    if data_frames:
-        frame = concat(data_frames, ignore_index=True)
-        logger.log("Data combined successfully. Dropping duplicates...", True)
-        # drop duplicated
-        frame.drop_duplicates()
+    if frame is not None:
+        # duplicates are merged after the transformation, once columns of all sources have the same names
+        logger.log("Data combined successfully.", True)
         return frame, total_source_rows, total_source_bytes
     else:
         logger.log("No data could be combined.", True)
         raise ValueError("No data could be combined.")
+
+
+# yield file name, validated chunk and row count of the chunk before validation for every chunk of every file
+def extract_chunks(folder, column_types, chunk_size, on_error="interactive"):
+    files = list_source_files(folder)
+
+    # do not continue if no files found
+    if not files:
+        logger.log("No CSV, XML, or JSON file in the specified folder.", False)
+        raise ValueError("No CSV, XML, or JSON file in the specified folder.")
+
+    # start a new rejects file for this run
+    init_rejects()
+
+    for file in files:
+        file_path = path.join(folder, file)
+        try:
+            logger.log(f"Reading file {file} in chunks of {chunk_size} rows...", True)
+            chunks = iter(readers[get_extension(file)][1](file_path, chunk_size, column_types))
+            while True:
+                # only reading and validating is measured, not what happens with the chunk afterward
+                with metrics.stage("extract") as rows:
+                    start = perf_counter()
+                    df = next(chunks, None)
+                    if df is None:
+                        break
+                    source_rows = len(df)
+                    rejects = []
+                    try:
+                        # validate data types
+                        df = validate_data_types(df, file, column_types, on_error, rejects)
+                    finally:
+                        save_rejects(rejects)
+                    record_file_metrics(file, df, source_rows, 0, rejects, perf_counter() - start)
+                    rows["rows_in"] = source_rows
+                    rows["rows_out"] = len(df)
+                yield file, df, source_rows
+            metrics.record_file(file, bytes=path.getsize(file_path))
+        except Exception as e:
+            metrics.record_file(file, failed=1)
+            logger.log(f"Could not read file {file}: {e}", True, logger.ERROR)
+            if on_error == "fail":
+                raise
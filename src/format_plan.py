@@ -0,0 +1,229 @@
+from dataclasses import dataclass
+from hashlib import sha256
+from json import loads
+from os import path, makedirs
+from pickle import dump, load
+from src import logger
+from src.constraints import Constraint, compile_constraint
+from src.normalizers import Normalizer, compile_normalizers
+
+# dynamically get path of script file and place cached files next to it
+cache_folder = path.join(path.dirname(path.abspath(__file__)), "cache")
+# increase whenever compiled plans change, so outdated cached plans are not used
+plan_version = 4
+
+date_types = ["datetime_DMY_.", "datetime_MDY_.", "datetime_YMD_.", "datetime_DMY_-", "datetime_MDY_-",
+              "datetime_YMD_-"]
+source_types = ["int", "float", "str", "bool"] + date_types
+# further target types are declared as normalizers, e.g. gender and mail
+target_types = list(source_types)
+calc_types = ["AGE", "BIRTHDATE"]
+
+# target types each source type can be mapped to without a calculation, text can be mapped to every normalizer
+compatible_types = {
+    "int": ["int", "float", "str"],
+    "float": ["int", "float", "str"],
+    "str": ["str", "bool"],
+    "bool": ["bool", "int", "str"],
+}
+compatible_types.update({date_type: date_types + ["str"] for date_type in date_types})
+
+
+@dataclass(frozen=True)
+class Rule:
+    source: str
+    # RENAME, SPLIT, CALC or DISCARD
+    action: str
+    targets: tuple[str, ...] = ()
+    # separator for SPLIT, calculation type for CALC
+    argument: str = ""
+    # source date format and separator, e.g. ('DMY', '.') for 'datetime_DMY_.'
+    date_format: tuple[str, str] | None = None
+
+
+@dataclass(frozen=True)
+class TargetColumn:
+    name: str
+    # data type without tags
+    type: str
+    required: bool = False
+    # normalizer of the type, e.g. for bool, gender or mail
+    normalizer: Normalizer | None = None
+    # REQUIRED, UNIQUE, MIN, MAX and PATTERN tags of the column
+    constraints: tuple[Constraint, ...] = ()
+
+
+@dataclass
+class FormatPlan:
+    column_types: dict[str, str]
+    column_mapping: dict[str, str]
+    target_frame_columns: dict[str, str]
+    rules: dict[str, Rule]
+    targets: dict[str, TargetColumn]
+    normalizers: dict[str, Normalizer]
+    # hash of the format file the plan was compiled from
+    fingerprint: str = ""
+
+    # rules for the given source columns, in the order of the columns
+    def rules_for(self, columns) -> list[Rule]:
+        return [self.rules[column] for column in columns if column in self.rules]
+
+    @property
+    def required_columns(self) -> list[str]:
+        return [target.name for target in self.targets.values() if target.required]
+
+    # data types of the source columns the transformation uses, discarded and unmapped columns are not read at all
+    @property
+    def read_column_types(self) -> dict[str, str]:
+        return {column: column_type for column, column_type in self.column_types.items()
+                if column in self.rules and self.rules[column].action != "DISCARD"}
+
+    @property
+    def constraints(self) -> list[Constraint]:
+        return [constraint for target in self.targets.values() for constraint in target.constraints]
+
+
+def compile_target(name, definition, normalizers, errors) -> TargetColumn:
+    # 'int§REQUIRED§MIN:0' > type int, required, at least 0
+    parts = definition.split("§")
+    if parts[0] not in target_types and parts[0] not in normalizers:
+        errors.append(f"Unknown data type '{parts[0]}' for target column {name}.")
+    constraints = [compile_constraint(name, parts[0], tag, date_types, errors) for tag in parts[1:]]
+    constraints = tuple(constraint for constraint in constraints if constraint is not None)
+    required = any(constraint.name == "REQUIRED" for constraint in constraints)
+    return TargetColumn(name, parts[0], required, normalizers.get(parts[0]), constraints)
+
+
+def check_target(column, target, value_type, targets, errors):
+    if target not in targets:
+        errors.append(f"Column {column} is mapped to {target}, which is not a target column.")
+    elif value_type == "str" and targets[target].normalizer is not None:
+        return
+    elif targets[target].type not in compatible_types.get(value_type, []):
+        errors.append(f"Column {column} of type {value_type} can not be mapped to {target} of type "
+                      f"{targets[target].type}.")
+
+
+def compile_rule(column, mapping, column_types, targets, errors) -> Rule:
+    column_type = column_types.get(column)
+    if column_type is None:
+        errors.append(f"Column {column} is mapped but has no data type in column_types.")
+    # e.g. 'datetime_DMY_.' > ('DMY', '.')
+    date_format = None
+    if column_type in date_types:
+        date_format = (column_type.split("_")[1], column_type.split("_")[2])
+
+    parts = mapping.split("§")
+    if mapping.startswith("§DISCARD"):
+        return Rule(column, "DISCARD", date_format=date_format)
+
+    # '§CALC§AGE§member_age' > calculation type AGE into member_age
+    elif mapping.startswith("§CALC"):
+        if len(parts) != 4:
+            errors.append(f"Calculation '{mapping}' of column {column} needs a type and one target column.")
+            return Rule(column, "DISCARD", date_format=date_format)
+        calc_type, target = parts[2], parts[3]
+        if calc_type not in calc_types:
+            errors.append(f"Unknown calculation type '{calc_type}' for column {column}.")
+        elif calc_type == "AGE":
+            if column_type is not None and column_type not in date_types:
+                errors.append(f"Calculation AGE of column {column} needs a date, but the column is {column_type}.")
+            check_target(column, target, "int", targets, errors)
+        elif calc_type == "BIRTHDATE":
+            if column_type is not None and column_type not in ["int", "float"]:
+                errors.append(f"Calculation BIRTHDATE of column {column} needs a number, but the column is "
+                              f"{column_type}.")
+            check_target(column, target, "datetime_DMY_-", targets, errors)
+        return Rule(column, "CALC", (target,), calc_type, date_format)
+
+    # '§SPLIT§ §first_name§last_name' > separator ' ' into first_name and last_name
+    elif mapping.startswith("§SPLIT"):
+        if len(parts) < 4 or parts[2] == "":
+            errors.append(f"Split '{mapping}' of column {column} needs a separator and at least one target column.")
+            return Rule(column, "DISCARD", date_format=date_format)
+        if column_type is not None and column_type != "str":
+            errors.append(f"Split of column {column} needs text, but the column is {column_type}.")
+        for target in parts[3:]:
+            check_target(column, target, "str", targets, errors)
+        return Rule(column, "SPLIT", tuple(parts[3:]), parts[2], date_format)
+
+    elif mapping.startswith("§"):
+        errors.append(f"Unknown mapping '{mapping}' for column {column}.")
+        return Rule(column, "DISCARD", date_format=date_format)
+
+    if column_type is not None:
+        check_target(column, mapping, column_type, targets, errors)
+    return Rule(column, "RENAME", (mapping,), date_format=date_format)
+
+
+# validate the format data and turn it into a plan, all problems are reported at once
+def compile_format(format_data) -> FormatPlan:
+    errors = []
+    for key in ["column_types", "column_mapping", "target_frame_columns"]:
+        if key not in format_data:
+            errors.append(f"Format file is missing '{key}'.")
+    if errors:
+        raise ValueError("Invalid format file:\n" + "\n".join(errors))
+
+    column_types: dict[str, str] = format_data['column_types']
+    column_mapping: dict[str, str] = format_data['column_mapping']
+    target_frame_columns: dict[str, str] = format_data['target_frame_columns']
+
+    for column, column_type in column_types.items():
+        if column_type not in source_types:
+            errors.append(f"Unknown data type '{column_type}' for column {column}.")
+        if column not in column_mapping:
+            logger.log(f"Column {column} has a data type but is not mapped and will be ignored.", False,
+                       logger.WARNING)
+
+    normalizers = compile_normalizers(format_data.get('normalizers'), errors)
+    for name, normalizer in normalizers.items():
+        if name in source_types and name != "bool":
+            errors.append(f"Normalizer {name} can not replace the data type {name}.")
+        elif name == "bool" and normalizer.pattern is not None:
+            errors.append("Normalizer bool needs 'values', a pattern can not produce 1 and 0.")
+    targets = {name: compile_target(name, definition, normalizers, errors)
+               for name, definition in target_frame_columns.items()}
+    rules = {column: compile_rule(column, mapping, column_types, targets, errors)
+             for column, mapping in column_mapping.items()}
+
+    mapped_targets = {target for rule in rules.values() for target in rule.targets}
+    for target in targets:
+        if target not in mapped_targets:
+            logger.log(f"No column is mapped to target column {target}, it will stay empty.", False, logger.WARNING)
+
+    if errors:
+        for error in errors:
+            logger.log(error, True, logger.ERROR)
+        raise ValueError("Invalid format file:\n" + "\n".join(errors))
+
+    return FormatPlan(column_types, column_mapping, target_frame_columns, rules, targets, normalizers)
+
+
+# load a format file, compiled plans are cached by the hash of the file content
+def load_format(format_file) -> FormatPlan:
+    with open(format_file, 'rb') as f:
+        content = f.read()
+
+    file_hash = sha256(content + f"§{plan_version}".encode('utf-8')).hexdigest()
+    cache_path = path.join(cache_folder, f"format_{file_hash}.pickle")
+    if path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                plan = load(f)
+            logger.log(f"Using compiled format from cache {cache_path}", False)
+            return plan
+        except Exception as e:
+            logger.log(f"Could not load compiled format from cache {cache_path}: {e}", False, logger.WARNING)
+
+    logger.log(f"Compiling format file {format_file}...", False)
+    plan = compile_format(loads(content.decode('utf-8')))
+    plan.fingerprint = file_hash
+
+    try:
+        makedirs(cache_folder, exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            dump(plan, f)
+    except OSError as e:
+        logger.log(f"Could not cache compiled format to {cache_path}: {e}", False, logger.WARNING)
+    return plan
@@ -0,0 +1,123 @@
+from hashlib import sha256
+from json import load, dump
+from os import path, makedirs, remove, stat
+from pandas import DataFrame, concat, read_pickle
+from src import logger, extractor, transformer, dtypes, metrics, xml_reader
+from src.format_plan import FormatPlan, cache_folder
+
+# increase whenever the content of shards changes, so outdated shards are not used
+shard_version = 3
+
+
+# folder holding manifest and shards of a source folder
+def get_shard_folder(folder) -> str:
+    folder_hash = sha256(path.abspath(folder).encode('utf-8')).hexdigest()[:16]
+    return path.join(cache_folder, "incremental", folder_hash)
+
+
+def hash_file(file_path) -> str:
+    file_hash = sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def load_manifest(manifest_path, settings) -> dict:
+    if path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = load(f)
+            # shards made with another format or error handling can not be reused
+            if manifest.get("settings") == settings:
+                return manifest
+            logger.log("Format or settings changed since the last run, all files are processed again.", True)
+        except Exception as e:
+            logger.log(f"Could not read manifest {manifest_path}: {e}", True, logger.WARNING)
+    return {"settings": settings, "files": {}}
+
+
+# return True if the file still matches its manifest entry, the content is only hashed if size or time changed
+def is_unchanged(file_path, entry) -> bool:
+    if entry is None or not path.exists(entry["shard"]):
+        return False
+    file_stat = stat(file_path)
+    if file_stat.st_size != entry["size"]:
+        return False
+    if file_stat.st_mtime == entry["mtime"]:
+        return True
+    if hash_file(file_path) != entry["hash"]:
+        return False
+    # only the time changed
+    entry["mtime"] = file_stat.st_mtime
+    return True
+
+
+# extract and transform only files that are new or changed since the last run, all others are read from their shards
+# return combined transformed frame, total amount of rows in source data and combined size of source data
+def extract_transform(folder, plan: FormatPlan, on_error="interactive", workers=1, legacy=False,
+                      partition_size=transformer.default_partition_size) \
+        -> tuple[DataFrame, int, int]:
+    shard_folder = get_shard_folder(folder)
+    makedirs(shard_folder, exist_ok=True)
+    manifest_path = path.join(shard_folder, "manifest.json")
+    settings = {"format": plan.fingerprint, "on_error": on_error, "xml_row_path": xml_reader.row_path,
+                "shard_version": shard_version}
+    manifest = load_manifest(manifest_path, settings)
+
+    files = extractor.list_source_files(folder)
+    if not files:
+        logger.log("No CSV, XML, or JSON file in the specified folder.", False)
+        raise ValueError("No CSV, XML, or JSON file in the specified folder.")
+
+    # deleted sources fall out of the result
+    for file in list(manifest["files"]):
+        if file not in files:
+            logger.log(f"File {file} was removed, dropping its cached data.", True)
+            shard = manifest["files"].pop(file)["shard"]
+            if path.exists(shard):
+                remove(shard)
+
+    changed_files = [file for file in files if not is_unchanged(path.join(folder, file), manifest["files"].get(file))]
+    logger.log(f"{len(files) - len(changed_files)} files unchanged, {len(changed_files)} files to process.", True)
+
+    # start a new rejects file for this run
+    extractor.init_rejects()
+
+    with metrics.stage("extract") as rows:
+        results = extractor.extract_files(folder, changed_files, plan.read_column_types, on_error, workers)
+        rows["rows_in"] = sum(source_rows for df, source_rows, source_bytes in results)
+        rows["rows_out"] = sum(len(df) for df, source_rows, source_bytes in results if df is not None)
+    metrics.count("unchanged_files", len(files) - len(changed_files))
+    for file, (df, source_rows, source_bytes) in zip(changed_files, results):
+        if df is None:
+            manifest["files"].pop(file, None)
+            continue
+        file_path = path.join(folder, file)
+        transformed_frame = transformer.transform(df, plan, legacy, workers, partition_size)
+        shard = path.join(shard_folder, f"{sha256(file.encode('utf-8')).hexdigest()[:16]}.pickle")
+        transformed_frame.to_pickle(shard)
+        manifest["files"][file] = {
+            "path": path.abspath(file_path),
+            "size": source_bytes,
+            "mtime": stat(file_path).st_mtime,
+            "hash": hash_file(file_path),
+            "rows": source_rows,
+            "shard": shard,
+        }
+
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        dump(manifest, f, indent=2)
+
+    # rebuild the result from the shards, in the order of the files
+    entries = [manifest["files"][file] for file in files if file in manifest["files"]]
+    if not entries:
+        logger.log("No data could be combined.", True)
+        raise ValueError("No data could be combined.")
+    with metrics.stage("combine") as rows:
+        frame = concat([read_pickle(entry["shard"]) for entry in entries], ignore_index=True)
+        # columns of shards with different categories are combined as objects
+        frame = dtypes.apply_target_dtypes(frame, plan.targets)
+        rows["rows_in"] = len(frame)
+    logger.log(f"Combined data of {len(entries)} files.", True)
+    return frame, sum(entry["rows"] for entry in entries), sum(entry["size"] for entry in entries)
@@ -1,113 +1,299 @@
 import os
+from importlib.util import find_spec
+from time import perf_counter
 
 from pandas import DataFrame
-from sqlalchemy import create_engine
-from src import logger
+from sqlalchemy import create_engine, inspect, MetaData, Table
+from src import logger, dtypes, metrics
+from src.format_plan import TargetColumn
 
-# return size of the saved file
-def save_to_csv(frame : DataFrame) -> int:
-    logger.log("Saving results to CSV", False)
+# targets that can be written chunk by chunk
+stream_targets = ["csv", "json", "sql"]
+# columnar targets need the optional pyarrow package
+columnar_targets = ["parquet", "feather"]
+# compression of text targets, chosen by the ending of the target path
+compression_extensions = {".gz": None, ".zst": "zstandard"}
+
+# how existing tables are handled: replace the table, append rows, or replace rows with the same key
+sql_modes = ["replace", "append", "upsert"]
+# rows per executemany batch
+sql_chunk_size = 10000
+# pragmas used while loading into SQLite, the previous values are restored afterward
+sqlite_bulk_pragmas = {"synchronous": "OFF", "journal_mode": "MEMORY", "temp_store": "MEMORY", "cache_size": "-65536"}
+
+# database engines by url, so pooled connections are reused between saves
+engines = {}
+
+
+# accept a SQLAlchemy url, or a path to a SQLite file
+def get_database_url(path) -> str:
+    return path if "://" in path else f"sqlite:///{path}"
+
+
+def get_engine(url):
+    if url not in engines:
+        engines[url] = create_engine(url, pool_pre_ping=True)
+    return engines[url]
+
+
+# return size of the database file, or 0 if the database is not a local file
+def get_database_size(url) -> int:
+    database = get_engine(url).url.database
+    if get_engine(url).dialect.name == "sqlite" and database and os.path.exists(database):
+        return os.path.getsize(database)
+    return 0
+
+
+# current values of the pragmas, e.g. journal_mode 'wal', which is stored in the database file
+def get_pragmas(connection, names) -> dict[str, str]:
+    return {name: str(connection.exec_driver_sql(f"PRAGMA {name}").scalar()) for name in names}
+
+
+def set_pragmas(connection, pragmas: dict[str, str]):
+    for name, value in pragmas.items():
+        connection.exec_driver_sql(f"PRAGMA {name}={value}")
+    connection.commit()
+
+
+# delete all rows whose key is contained in keys
+def delete_keys(connection, table_name, key, keys):
+    if not inspect(connection).has_table(table_name):
+        return
+    table = Table(table_name, MetaData(), autoload_with=connection)
+    # stay below the parameter limit of SQLite
+    for start in range(0, len(keys), 500):
+        connection.execute(table.delete().where(table.c[key].in_(keys[start:start + 500])))
+
+
+# write the frame in batches inside a single transaction
+def write_sql(frame: DataFrame, url, table_name, mode="replace", key=None):
+    if mode == "upsert":
+        if key not in frame.columns:
+            raise ValueError(f"Key column '{key}' for upsert is not a target column.")
+        # keep only the last row per key, rows without a key are always inserted
+        frame = frame[frame[key].isna() | ~frame.duplicated(subset=[key], keep="last")]
+
+    engine = get_engine(url)
+    sqlite = engine.dialect.name == "sqlite"
+    start = perf_counter()
+    with engine.connect() as connection:
+        if sqlite:
+            previous_pragmas = get_pragmas(connection, sqlite_bulk_pragmas.keys())
+            set_pragmas(connection, sqlite_bulk_pragmas)
+        try:
+            with connection.begin():
+                if mode == "upsert":
+                    delete_keys(connection, table_name, key, frame[key].dropna().tolist())
+                frame.to_sql(name=table_name, con=connection, if_exists="replace" if mode == "replace" else "append",
+                             index=False, chunksize=sql_chunk_size)
+        finally:
+            if sqlite:
+                set_pragmas(connection, previous_pragmas)
+
+    elapsed = perf_counter() - start
+    logger.log(f"Saved {len(frame)} rows to table '{table_name}' in {elapsed:.2f}s "
+               f"({len(frame) / max(elapsed, 1e-9):.0f} rows/s)", True)
+
+
+# prompt for table name, mode and key column for a database target, unless they are given
+def get_sql_options(table_name=None, mode=None, key=None) -> tuple[str, str, str | None]:
+    if table_name is None:
+        table_name = input("Enter the table name to save data: ")
+        logger.log(f"User entered table name: {table_name}", False)
+    while mode not in sql_modes:
+        mode = input(f"Enter how to handle an existing table [{', '.join(sql_modes)}]: ")
+        if mode in sql_modes:
+            logger.log(f"User chose mode {mode}", False)
+        else:
+            print("Invalid input. Enter a valid mode.")
+            logger.log(f"Invalid input entered: {mode}", False)
+    if mode == "upsert" and key is None:
+        key = input("Enter the key column: ")
+        logger.log(f"User entered key column: {key}", False)
+    return table_name, mode, key
+
+
+# prompt for a SQLAlchemy url or a path to a SQLite file
+def get_database_target() -> str:
+    while True:
+        path = input("Enter database url or target path (ending with '.db'): ")
+        if "://" in path or path.endswith(".db"):
+            logger.log(f"User entered database: {path}", False)
+            return get_database_url(path)
+        print("Invalid path. Enter a database url or a valid path ending with '.db'.")
+        logger.log(f"Invalid path entered: {path}", False)
+
+
+def is_compression_available(path) -> bool:
+    for compression_extension, package in compression_extensions.items():
+        if path.endswith(compression_extension):
+            return package is None or find_spec(package) is not None
+    return True
+
+
+# with compression, the path may additionally end with '.gz' or '.zst'
+def get_target_path(extension, compression=False) -> str:
+    extensions = [extension]
+    hint = f"ending with '{extension}'"
+    if compression:
+        extensions += [extension + compression_extension for compression_extension in compression_extensions]
+        hint += f", optionally followed by {' or '.join(repr(e) for e in compression_extensions)} to compress"
     path_valid = False
     path = ""
     while not path_valid:
-        path = input("Enter target path (ending with '.csv'): ")
-        if path.endswith(".csv"):
+        path = input(f"Enter target path ({hint}): ")
+        if not any(path.endswith(e) for e in extensions):
+            print(f"Invalid path. Enter a valid path {hint}.")
+            logger.log(f"Invalid path entered: {path}", False)
+        elif not is_compression_available(path):
+            print("This compression needs the 'zstandard' package. Install it or choose another compression.")
+            logger.log(f"Compression not available for path: {path}", False)
+        else:
             path_valid = True
             logger.log(f"User entered path: {path}", False)
-        else:
-            print("Invalid path. Enter a valid path ending with '.csv'.")
-            logger.log(f"Invalid path entered: {path}", False)
+    return path
+
+
+# return size of the saved file
+def save_to_csv(frame : DataFrame, path=None) -> int:
+    logger.log("Saving results to CSV", False)
+    if path is None:
+        path = get_target_path(".csv", True)
     logger.log(f"Saving results as CSV to {path}", True)
-    frame.to_csv(path, index=False, sep=';')
+    with metrics.stage("load", len(frame)):
+        dtypes.to_text_columns(frame).to_csv(path, index=False, sep=';')
     logger.log("Results saved successfully.", True)
     return os.path.getsize(path)
 
 
 # return size of the saved file
-def save_to_xml(frame : DataFrame) -> int:
+def save_to_xml(frame : DataFrame, path=None) -> int:
     logger.log("Saving results to XML", False)
-    path_valid = False
-    path = ""
-    while not path_valid:
-        path = input("Enter target path (ending with '.xml'): ")
-        if path.endswith(".xml"):
-            path_valid = True
-            logger.log(f"User entered path: {path}", False)
-        else:
-            print("Invalid path. Enter a valid path ending with '.xml'.")
-            logger.log(f"Invalid path entered: {path}", False)
+    if path is None:
+        path = get_target_path(".xml", True)
     logger.log(f"Saving results as XML to {path}", True)
-    frame.to_xml(path, index=False)
+    with metrics.stage("load", len(frame)):
+        dtypes.to_text_columns(frame).to_xml(path, index=False)
     logger.log("Results saved successfully.", True)
     return os.path.getsize(path)
 
 
 # return size of the saved file
-def save_to_json(frame : DataFrame) -> int:
+def save_to_json(frame : DataFrame, path=None) -> int:
     logger.log("Saving results to JSON", False)
-    path_valid = False
-    path = ""
-    while not path_valid:
-        path = input("Enter target path (ending with '.json'): ")
-        if path.endswith(".json"):
-            path_valid = True
-            logger.log(f"User entered path: {path}", False)
-        else:
-            print("Invalid path. Enter a valid path ending with '.json'.")
-            logger.log(f"Invalid path entered: {path}", False)
+    if path is None:
+        path = get_target_path(".json", True)
     logger.log(f"Saving results as JSON to {path}", True)
-    frame.to_json(path, index=False)
+    with metrics.stage("load", len(frame)):
+        dtypes.to_text_columns(frame).to_json(path, index=False)
     logger.log("Results saved successfully.", True)
     return os.path.getsize(path)
 
 
 # return size of the saved file
-def save_to_sql(frame: DataFrame) -> int:
-    logger.log("Saving results to SQL database", False)
-    path_valid = False
-    path = ""
-    while not path_valid:
-        path = input("Enter target path (ending with '.db'): ")
-        if path.endswith(".db"):
-            path_valid = True
-            logger.log(f"User entered path: {path}", False)
-        else:
-            print("Invalid path. Enter a valid path ending with '.db'.")
-            logger.log(f"Invalid path entered: {path}", False)
+def save_to_parquet(frame: DataFrame, targets: dict[str, TargetColumn], path=None) -> int:
+    logger.log("Saving results to Parquet", False)
+    if path is None:
+        path = get_target_path(".parquet")
+    logger.log(f"Saving results as Parquet to {path}", True)
+    with metrics.stage("load", len(frame)):
+        dtypes.apply_target_dtypes(frame, targets).to_parquet(path, index=False)
+    logger.log("Results saved successfully.", True)
+    return os.path.getsize(path)
 
-    table_name = input("Enter the table name to save data: ")
-    engine = create_engine(f"sqlite:///{path}")
-    print("Saving to database...")
-    logger.log(f"Attempting to save to table '{table_name}' in database: {path}", False)
 
-    frame.to_sql(name=table_name, con=engine, if_exists="replace", index=False)
+# return size of the saved file
+def save_to_feather(frame: DataFrame, targets: dict[str, TargetColumn], path=None) -> int:
+    logger.log("Saving results to Feather", False)
+    if path is None:
+        path = get_target_path(".feather")
+    logger.log(f"Saving results as Feather to {path}", True)
+    with metrics.stage("load", len(frame)):
+        # feather needs a default index
+        dtypes.apply_target_dtypes(frame, targets).reset_index(drop=True).to_feather(path)
     logger.log("Results saved successfully.", True)
     return os.path.getsize(path)
 
 
 # return size of the saved file
-def save(frame : DataFrame) -> int:
-    valid_input = False
-    file_size = 0
-    while not valid_input:
-        target = input("Enter target format [csv, json, xml, sql]: ")
+def save_to_sql(frame: DataFrame, url=None, sql_options=(None, None, None)) -> int:
+    logger.log("Saving results to SQL database", False)
+    if url is None:
+        url = get_database_target()
+    table_name, mode, key = get_sql_options(*sql_options)
+    print("Saving to database...")
+    logger.log(f"Attempting to save to table '{table_name}' in database: {url}", False)
+
+    with metrics.stage("load", len(frame)):
+        write_sql(dtypes.to_text_columns(frame), url, table_name, mode, key)
+    logger.log("Results saved successfully.", True)
+    return get_database_size(url)
+
+
+def get_target_formats() -> list[str]:
+    formats = ["csv", "json", "xml", "sql"]
+    if find_spec("pyarrow") is not None:
+        formats += columnar_targets
+    return formats
+
+
+# return size of the saved file
+# format, path and database options are prompted for unless they are given
+def save(frame : DataFrame, targets: dict[str, TargetColumn], target=None, path=None,
+         sql_options=(None, None, None)) -> int:
+    formats = get_target_formats()
+    while target not in formats:
+        if target is not None:
+            print("Invalid input. Enter a valid target format.")
+            logger.log(f"Invalid input entered: {target}", False)
+        target = input(f"Enter target format [{', '.join(formats)}]: ")
+    logger.log(f"Chosen target format {target}", False)
+
+    if target == "csv":
+        return save_to_csv(frame, path)
+    elif target == "json":
+        return save_to_json(frame, path)
+    elif target == "xml":
+        return save_to_xml(frame, path)
+    elif target == "sql":
+        return save_to_sql(frame, None if path is None else get_database_url(path), sql_options)
+    elif target == "parquet":
+        return save_to_parquet(frame, targets, path)
+    return save_to_feather(frame, targets, path)
+
+
+# prompt for format, path and database options of a target that is written chunk by chunk, unless they are given
+def get_stream_target(target=None, path=None, sql_options=(None, None, None)) -> tuple[str, str, tuple | None]:
+    while target not in stream_targets:
+        if target is not None:
+            print("Invalid input. Enter a valid target format.")
+            logger.log(f"Invalid input entered: {target}", False)
+        target = input(f"Enter target format [{', '.join(stream_targets)}]: ")
+    logger.log(f"Chosen target format {target}", False)
+
+    if target == "sql":
+        return target, get_database_target() if path is None else get_database_url(path), get_sql_options(*sql_options)
+    return target, get_target_path(f".{target}") if path is None else path, None
+
+
+def get_saved_size(target, path) -> int:
+    if target == "sql":
+        return get_database_size(path)
+    return os.path.getsize(path)
+
+
+# write one chunk to the target, the first chunk replaces any existing data and later chunks are appended
+# json is written as one record per line, so it can be appended to
+# for databases, the first chunk uses the chosen mode, later chunks append or upsert
+def save_chunk(frame: DataFrame, target, path, sql_options=None, first_chunk=False):
+    with metrics.stage("load", len(frame)):
+        frame = dtypes.to_text_columns(frame)
         if target == "csv":
-            valid_input = True
-            logger.log(f"User chose target format CSV", False)
-            file_size = save_to_csv(frame)
+            frame.to_csv(path, mode="w" if first_chunk else "a", header=first_chunk, index=False, sep=';')
         elif target == "json":
-            valid_input = True
-            logger.log(f"User chose target format JSON", False)
-            file_size = save_to_json(frame)
-        elif target == "xml":
-            valid_input = True
-            logger.log(f"User chose target format XML", False)
-            file_size = save_to_xml(frame)
+            frame.to_json(path, mode="w" if first_chunk else "a", orient="records", lines=True)
         elif target == "sql":
-            valid_input = True
-            logger.log(f"User chose to save to database", False)
-            file_size = save_to_sql(frame)
+            table_name, mode, key = sql_options
+            write_sql(frame, path, table_name, mode if first_chunk or mode == "upsert" else "append", key)
         else:
-            print("Invalid input. Enter a valid target format.")
-            logger.log(f"Invalid input entered: {target}", False)
-    return file_size
\ No newline at end of file
+            raise ValueError(f"Target format {target} can not be written in chunks.")
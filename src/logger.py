@@ -1,22 +1,99 @@
-from os import path
+import os
+import sys
+from atexit import register
+from logging import DEBUG, INFO, WARNING, ERROR
+from os import path, getpid
+from queue import Queue, Empty
+from threading import Thread
 
 # dynamically get path of script file and place log next to it
 log_file_path = path.join(path.dirname(path.abspath(__file__)), "log.txt")
 
+# messages below this level are not written to the log file
+levels = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+log_level = INFO
 
-def log(message, log_to_console):
+# messages waiting to be written by the writer thread of this process
+buffer = Queue()
+writer_thread = None
+writer_pid = None
+
+
+def write_messages():
+    # keep the file open and write everything waiting in the buffer before flushing once
+    # characters that can not be encoded are escaped, e.g. file names with undecodable bytes
+    with open(log_file_path, "a", encoding="utf-8", errors="backslashreplace") as f:
+        while True:
+            messages = [buffer.get()]
+            try:
+                while True:
+                    messages.append(buffer.get_nowait())
+            except Empty:
+                pass
+            # the thread must never stop, flush waits until every message is marked as done
+            try:
+                for message in messages:
+                    f.write("\n")
+                    f.write(str(message))
+                f.flush()
+            except Exception as e:
+                print(f"Could not write to log file: {e}", file=sys.stderr)
+            finally:
+                for _ in messages:
+                    buffer.task_done()
+
+
+def start_writer():
+    global writer_thread, writer_pid
+    writer_thread = Thread(target=write_messages, name="log-writer", daemon=True)
+    writer_pid = getpid()
+    writer_thread.start()
+
+
+def is_enabled(level) -> bool:
+    return level >= log_level
+
+
+def log(message, log_to_console, level=INFO):
     # optionally: print to console
     if log_to_console:
         print(message)
-    # open log file, write output after new line, close files
-    f = open(log_file_path, "a")
-    f.write("\n")
-    f.write(message)
-    f.close()
+    if level < log_level:
+        return
+    # a process started by a process pool needs its own writer thread
+    if writer_pid != getpid():
+        start_writer()
+    buffer.put(message)
 
 
-def init_logger():
+def flush():
+    # wait until every buffered message is written to the log file
+    if writer_pid == getpid():
+        buffer.join()
+
+
+def set_level(level):
+    global log_level
+    log_level = levels[level] if isinstance(level, str) else level
+
+
+def init_logger(level=INFO):
     # create log file
     file = open(log_file_path, "w")
     file.write("")
     file.close()
+    set_level(level)
+
+
+def reset_after_fork():
+    # the writer thread of the parent process does not exist in a forked process
+    global buffer, writer_thread, writer_pid
+    buffer = Queue()
+    writer_thread = None
+    writer_pid = None
+
+
+# write remaining messages when the program exits
+register(flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -1,12 +1,16 @@
+import sys
+from argparse import ArgumentParser, ArgumentTypeError, BooleanOptionalAction
 from json import load
 from os import path
-from src import logger, extractor, transformer, loader
+from src import logger, extractor, transformer, loader, incremental, merger, metrics, dtypes, xml_reader, constraints, watcher, schema
+from src.format_plan import FormatPlan, load_format
 
 
-def get_data_folder():
-    # prompt user for folder
-    folder = input("Please enter path to files: ")
-    logger.log(f"User entered path: {folder}", False)
+def get_data_folder(folder=None):
+    # prompt user for folder, unless given
+    if folder is None:
+        folder = input("Please enter path to files: ")
+        logger.log(f"User entered path: {folder}", False)
 
     # check if path exists
     if not path.exists(folder):
@@ -16,21 +20,19 @@ def get_data_folder():
     return folder
 
 
-def get_format_file():
-    # prompt user for format file
-    format_file = input("Please enter path to format file: ")
-    logger.log(f"User entered format file path: {format_file}", False)
+def get_format_file(format_file=None) -> FormatPlan:
+    # prompt user for format file, unless given
+    if format_file is None:
+        format_file = input("Please enter path to format file: ")
+        logger.log(f"User entered format file path: {format_file}", False)
 
     # check if format file exists
     if not path.exists(format_file):
         logger.log("The specified format file does not exist.", False)
         raise FileNotFoundError("The specified format file does not exist.")
 
-    # load format from file
-    with open(format_file, 'r', encoding='utf-8') as f:
-        format_data = load(f)
-
-    return format_data
+    # load and validate format from file, or use the compiled format from the last run
+    return load_format(format_file)
 
 
 def format_bytes(value) -> str:
@@ -55,55 +57,264 @@ def format_bytes(value) -> str:
     return f"{return_value:.2f}".rstrip('00').rstrip('.') + symbol
 
 
-def print_statistic(source_rows, source_bytes, target_rows, target_bytes):
+# save is asked for unless given
+def print_statistic(source_rows, source_bytes, target_rows, target_bytes, save=None):
     statistic = "Statistics:\n"
     statistic += f"Source data rows: {source_rows}\n"
     statistic += f"Source data bytes: {format_bytes(source_bytes)}\n"
     statistic += f"Target data rows: {target_rows}\n"
     statistic += f"Target data bytes: {format_bytes(target_bytes)}\n"
-    statistic += f"Data row reduction: {(source_rows - target_rows) / source_rows * 100:.2f}%\n"
-    statistic += f"Data size reduction: {(source_bytes - target_bytes) / source_bytes * 100:.2f}%"
+    statistic += f"Data row reduction: {(source_rows - target_rows) / max(source_rows, 1) * 100:.2f}%\n"
+    statistic += f"Data size reduction: {(source_bytes - target_bytes) / max(source_bytes, 1) * 100:.2f}%"
+    metrics.count("source_rows", source_rows)
+    metrics.count("source_bytes", source_bytes)
+    metrics.count("target_rows", target_rows)
+    metrics.count("target_bytes", target_bytes)
     logger.log("\n\n" + statistic, True)
-    save = input("\nSave statistics to disc? [y, n]:")
-    if save.lower() == 'y':
+    if save is None:
+        save = input("\nSave statistics to disc? [y, n]:").lower() == 'y'
+    if save:
         print("Saving statistics...")
         logger.log("Saving statistics to disc", False)
-        with open(path.join(path.dirname(path.abspath(__file__)), "log.txt"), 'w') as f:
+        with open(path.join(path.dirname(path.abspath(__file__)), "statistics.txt"), 'w') as f:
             f.write(statistic)
         print("Statistics saved")
 
 
-def main():
-    # create logger file or clear content if exists
-    logger.init_logger()
+# split a target like 'parquet:out.parquet' or 'sql:postgresql://host/db' into format and path
+def parse_target(value) -> tuple[str, str]:
+    target, separator, target_path = value.partition(":")
+    if not separator or not target_path:
+        raise ArgumentTypeError(f"Target '{value}' must be given as format:path, e.g. csv:out.csv")
+    # checked before the data is processed, like the prompt for the target path does
+    if not loader.is_compression_available(target_path):
+        raise ArgumentTypeError(f"Target '{value}' needs the 'zstandard' package, install it or choose another "
+                                "compression")
+    return target, target_path
+
+
+# defaults from a config file are not checked by argparse, so unknown keys and values outside the choices fail here
+def check_config(parser: ArgumentParser, config: dict, config_file):
+    if not isinstance(config, dict):
+        parser.error(f"config file {config_file} must contain a json object")
+    actions = {action.dest: action for action in parser._actions if action.dest != "help"}
+    for key, value in config.items():
+        action = actions.get(key)
+        if action is None or key == "config":
+            parser.error(f"unknown option '{key}' in config file {config_file}")
+        if action.choices is not None and value not in action.choices:
+            choices = ", ".join(map(repr, action.choices))
+            parser.error(f"invalid value {value!r} for '{key}' in config file {config_file} (choose from {choices})")
+
+
+# every option left out is prompted for, except when it has a default
+# options can also be read from a json config file, with the option names as keys (e.g. "on_error")
+def parse_arguments(arguments=None):
+    parser = ArgumentParser(description="Extract, transform and load structured data.")
+    parser.add_argument("--config", help="json file with options, options given on the command line take precedence")
+    parser.add_argument("--input", help="folder containing the data files")
+    parser.add_argument("--format", help="format file describing the data and its mapping")
+    parser.add_argument("--target", type=parse_target,
+                        help="target format and path, e.g. csv:out.csv, parquet:out.parquet or sql:out.db")
+    parser.add_argument("--table", help="table name for sql targets")
+    parser.add_argument("--sql-mode", choices=loader.sql_modes, help="how to handle an existing table")
+    parser.add_argument("--key", help="key column for the upsert sql mode")
+    parser.add_argument("--save-statistics", action=BooleanOptionalAction, default=None,
+                        help="save the statistics to statistics.txt")
+    parser.add_argument("--on-error", choices=extractor.error_policies, default="interactive",
+                        help="what to do with values not matching their data type (default: interactive)")
+    parser.add_argument("--xml-row-path",
+                        help="path of the row elements in xml files, e.g. mitglied or /vereinsverwaltung/mitglied "
+                             "(default: the children of the root element)")
+    parser.add_argument("--infer-schema", action="store_true",
+                        help="infer data types and mappings of source columns missing in the format file, cached per "
+                             "layout of columns")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="stream the data in chunks of this many rows instead of loading all files at once")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes reading and validating files and transforming partitions in "
+                             "parallel (default: 1)")
+    parser.add_argument("--partition-size", type=int, default=transformer.default_partition_size,
+                        help="rows transformed by one process at a time with --workers, smaller inputs are transformed "
+                             f"in one process (default: {transformer.default_partition_size})")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process files that are new or changed since the last run, reuse cached results of "
+                             "all others")
+    parser.add_argument("--merge-on", nargs="?", const=",".join(merger.default_key_columns),
+                        help="merge rows with the same values in these comma separated target columns into one record "
+                             f"(without columns: {','.join(merger.default_key_columns)})")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process files as they arrive in the input folder, appending them to a "
+                             "csv, json or sql target")
+    parser.add_argument("--archive-folder",
+                        help="folder files are moved to once they are saved with --watch (default: archive in the input "
+                             "folder)")
+    parser.add_argument("--quarantine-folder",
+                        help="folder files are moved to if they can not be processed with --watch (default: quarantine "
+                             "in the input folder)")
+    parser.add_argument("--constraint-rejects",
+                        help="csv file rows violating a constraint of the target columns are written to, with the "
+                             "constraints they violate")
+    parser.add_argument("--memory-report", action="store_true",
+                        help="report how much memory the extracted and transformed data use")
+    parser.add_argument("--legacy-transform", action="store_true",
+                        help="transform row by row instead of column by column, to compare results")
+    parser.add_argument("--metrics-file", help="json file the metrics of the run are saved to (default: src/metrics.json)")
+    parser.add_argument("--prometheus-file", help="also save the metrics in the Prometheus text format to this file")
+    parser.add_argument("--profile", nargs="?", const=metrics.profile_folder,
+                        help="profile calls and memory allocations and save the results to this folder "
+                             "(default: src/profile)")
+    parser.add_argument("--log-level", choices=logger.levels.keys(), default="INFO",
+                        help="lowest level of messages written to the log file, DEBUG includes every processed value "
+                             "(default: INFO)")
+
+    config_file = parser.parse_known_args(arguments)[0].config
+    if config_file is not None:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            config = load(f)
+        check_config(parser, config, config_file)
+        parser.set_defaults(**config)
+    return parser.parse_args(arguments)
+
+
+# extract, transform and save one chunk at a time, so memory use does not depend on the size of the input
+# return total source rows, source bytes, target rows and target bytes
+def run_streaming(folder, plan: FormatPlan, arguments):
+    # ask for the target first, chunks are saved as soon as they are transformed
+    target, target_path, sql_options = loader.get_stream_target(*get_target_options(arguments))
+
+    source_files = set()
+    source_data_rows = 0
+    target_data_rows = 0
+    first_chunk = True
+    for file, chunk, chunk_rows in extractor.extract_chunks(folder, plan.read_column_types, arguments.chunk_size,
+                                                                    arguments.on_error):
+        source_files.add(file)
+        source_data_rows += chunk_rows
+        transformed_chunk = transformer.transform(chunk, plan, arguments.legacy_transform, arguments.workers,
+                                                  arguments.partition_size)
+        transformed_chunk = transformer.postprocess_frame(transformed_chunk, plan.constraints)
+        loader.save_chunk(transformed_chunk, target, target_path, sql_options, first_chunk)
+        target_data_rows += len(transformed_chunk)
+        first_chunk = False
+
+    source_data_bytes = sum(path.getsize(path.join(folder, file)) for file in source_files)
+    logger.log("Results saved successfully.", True)
+    return source_data_rows, source_data_bytes, target_data_rows, loader.get_saved_size(target, target_path)
+
+
+# process arriving files until stopped, the metrics are saved after every batch
+def run_watch(folder, plan: FormatPlan, arguments):
+    if arguments.on_error == "interactive":
+        raise ValueError("Files can not be watched with interactive error handling, choose another --on-error.")
+    if arguments.merge_on or arguments.chunk_size or arguments.incremental:
+        logger.log("--merge-on, --chunk-size and --incremental are ignored while watching.", True, logger.WARNING)
+    stream_target = loader.get_stream_target(*get_target_options(arguments))
+    watcher.watch(folder, plan, stream_target, arguments.on_error, arguments.legacy_transform, arguments.workers,
+                  arguments.partition_size, arguments.archive_folder, arguments.quarantine_folder,
+                  lambda: save_metrics(arguments, True))
 
+
+# return target format, path and database options given as arguments
+def get_target_options(arguments) -> tuple[str | None, str | None, tuple]:
+    target, target_path = arguments.target if arguments.target else (None, None)
+    return target, target_path, (arguments.table, arguments.sql_mode, arguments.key)
+
+
+def run(arguments):
     # get folder with data files
-    folder = get_data_folder()
+    folder = get_data_folder(arguments.input)
 
     # get file with data format information
-    format_data = get_format_file()
+    plan = get_format_file(arguments.format)
+    xml_reader.set_row_path(arguments.xml_row_path)
+    if arguments.infer_schema:
+        plan = schema.extend_plan(plan, folder)
+    # unique keys have to be remembered between chunks
+    constraints.start_run(arguments.constraint_rejects, remember_keys=bool(arguments.chunk_size or arguments.watch))
+
+    if arguments.watch:
+        run_watch(folder, plan, arguments)
+        return
 
-    # format and config values
-    column_types: dict[str, str] = format_data['column_types']
-    column_mapping: dict[str, str] = format_data['column_mapping']
-    target_frame_columns: dict[str, str] = format_data['target_frame_columns']
+    if arguments.chunk_size:
+        if arguments.merge_on:
+            logger.log("Records can not be merged while streaming, --merge-on is ignored.", True, logger.WARNING)
+        statistic = run_streaming(folder, plan, arguments)
+        print_statistic(*statistic, arguments.save_statistics)
+        return
 
-    # execute extract stage
-    extracted_data = extractor.extract(folder, column_types)
-    extracted_frame = extracted_data[0]
-    source_data_rows = extracted_data[1]
-    source_data_bytes = extracted_data[2]
+    if arguments.incremental:
+        # execute extract and transform stage for changed files only
+        transformed_frame, source_data_rows, source_data_bytes = incremental.extract_transform(
+            folder, plan, arguments.on_error, arguments.workers, arguments.legacy_transform, arguments.partition_size)
+    else:
+        # execute extract stage
+        extracted_data = extractor.extract(folder, plan.read_column_types, arguments.on_error, arguments.workers)
+        extracted_frame = extracted_data[0]
+        source_data_rows = extracted_data[1]
+        source_data_bytes = extracted_data[2]
+        if arguments.memory_report:
+            dtypes.report_memory(extracted_frame, "extracted")
 
-    # execute transform stage
-    transformed_frame = transformer.transform(extracted_frame, target_frame_columns, column_mapping, column_types)
+        # execute transform stage
+        transformed_frame = transformer.transform(extracted_frame, plan, arguments.legacy_transform, arguments.workers,
+                                                  arguments.partition_size)
+
+    if arguments.memory_report:
+        dtypes.report_memory(transformed_frame, "transformed")
+
+    # merge records of the same member from different sources
+    if arguments.merge_on:
+        key_columns = arguments.merge_on.split(",")
+        # rows without a member number are merged by name and date of birth instead
+        fallback_key_columns = merger.identity_key_columns if key_columns == merger.default_key_columns else None
+        transformed_frame = merger.merge_records(transformed_frame, key_columns, fallback_key_columns)[0]
+    # partial records are only dropped after merging, another source may have completed them
+    transformed_frame = transformer.postprocess_frame(transformed_frame, plan.constraints)
     target_data_rows = len(transformed_frame)
 
     # save data
-    target_data_bytes = loader.save(transformed_frame)
+    target_data_bytes = loader.save(transformed_frame, plan.targets, *get_target_options(arguments))
 
     # print statistic
-    print_statistic(source_data_rows, source_data_bytes, target_data_rows, target_data_bytes)
+    print_statistic(source_data_rows, source_data_bytes, target_data_rows, target_data_bytes,
+                    arguments.save_statistics)
+
+
+# return exit code, 0 on success and 1 on failure
+def main(arguments=None) -> int:
+    arguments = parse_arguments(arguments)
+
+    # create logger file or clear content if exists
+    logger.init_logger(arguments.log_level)
+
+    if arguments.profile:
+        metrics.start_profiling()
+    success = False
+    try:
+        run(arguments)
+        success = True
+    except Exception as e:
+        logger.log(f"Operation failed: {e}", True, logger.ERROR)
+        return 1
+    finally:
+        save_metrics(arguments, success)
+    return 0
+
+
+# metrics are also saved for failed runs, so slow or failing runs can be noticed
+def save_metrics(arguments, success):
+    if arguments.profile:
+        metrics.stop_profiling(arguments.profile)
+    report = metrics.get_report(success)
+    try:
+        metrics.save_report(report, arguments.metrics_file)
+        if arguments.prometheus_file:
+            metrics.save_prometheus(report, arguments.prometheus_file)
+    except OSError as e:
+        logger.log(f"Could not save metrics: {e}", True, logger.WARNING)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
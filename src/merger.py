@@ -0,0 +1,80 @@
+from numpy import arange, ndarray, where, zeros
+from pandas import DataFrame, Index, concat, to_numeric
+from pandas.api.types import is_numeric_dtype
+from pandas.util import hash_pandas_object
+from src import logger, metrics
+
+# columns identifying a member if no key columns are given
+default_key_columns = ["member_nr"]
+# key of rows without a member number, when merging on the member number
+identity_key_columns = ["first_name", "last_name", "date_of_birth"]
+
+
+# numbers are compared as numbers, so 1 and 1.0 match
+# text is lower cased without surrounding and repeated whitespace, so spellings of the same key match
+def normalize_keys(frame: DataFrame, key_columns) -> DataFrame:
+    keys = DataFrame(index=frame.index)
+    for column in key_columns:
+        values = frame[column]
+        numbers = to_numeric(values, errors="coerce") if not is_numeric_dtype(values) else values
+        if numbers.notna().sum() == values.notna().sum():
+            keys[column] = numbers
+        else:
+            text = values.astype("string").str.strip().str.lower().str.replace(r"\s+", " ", regex=True)
+            keys[column] = text.mask(text == "").astype(object)
+    return keys
+
+
+# hash of the normalized keys of every row, and whether the row has all of them
+def hash_keys(frame: DataFrame, key_columns) -> tuple[ndarray, ndarray]:
+    keys = normalize_keys(frame, key_columns)
+    keyed = keys.notna().all(axis=1).to_numpy()
+    hashes = zeros(len(frame), dtype="uint64")
+    hashes[keyed] = hash_pandas_object(keys[keyed], index=False).to_numpy()
+    return hashes, keyed
+
+
+# merge rows with the same key into one record, taking the first value found for each column
+# rows missing a key column are merged by the fallback key columns if given, into the record with the same fallback key
+# and a key if there is one, rows missing both are kept as they are
+# return merged frame in the order of first appearance and the amount of rows merged into others
+def merge_records(frame: DataFrame, key_columns=None, fallback_key_columns=None) -> tuple[DataFrame, int]:
+    key_columns = key_columns or default_key_columns
+    fallback_key_columns = fallback_key_columns or []
+    missing_columns = [column for column in key_columns + fallback_key_columns if column not in frame.columns]
+    if missing_columns:
+        raise ValueError(f"Key columns {', '.join(missing_columns)} are not target columns.")
+
+    logger.log(f"Merging records with the same {', '.join(key_columns)}...", True)
+    with metrics.stage("merge", len(frame)) as rows:
+        # group by a hash of the keys instead of comparing rows with each other
+        hashes, keyed = hash_keys(frame, key_columns)
+        # 0 for groups of the key, 1 for groups of the fallback key, so hashes of both can not collide
+        kinds = zeros(len(frame), dtype="int8")
+        grouped = keyed.copy()
+        if fallback_key_columns:
+            fallback_hashes, fallback_keyed = hash_keys(frame, fallback_key_columns)
+            fallback = ~keyed & fallback_keyed
+            # the first keyed record with the same fallback key takes the row
+            # looked up by position, mapping the hashes would turn them into floats if one row has no match
+            known_hashes = hashes[keyed & fallback_keyed]
+            known = Index(fallback_hashes[keyed & fallback_keyed])
+            first = ~known.duplicated()
+            positions = known[first].get_indexer(fallback_hashes[fallback])
+            found = positions >= 0
+            matched = fallback_hashes[fallback]
+            matched[found] = known_hashes[first][positions[found]]
+            hashes[fallback] = matched
+            kinds[fallback] = where(found, 0, 1)
+            grouped |= fallback
+
+        ordered_frame = frame.assign(merge_order=arange(len(frame)))
+        merged_frame = ordered_frame[grouped].groupby([kinds[grouped], hashes[grouped]], sort=False).first()
+        merged_frame = concat([merged_frame, ordered_frame[~grouped]], ignore_index=True)
+        merged_frame = merged_frame.sort_values("merge_order").drop(columns="merge_order").reset_index(drop=True)
+        rows["rows_out"] = len(merged_frame)
+
+    merged_rows = len(frame) - len(merged_frame)
+    metrics.count("merged_rows", merged_rows)
+    logger.log(f"Merged {merged_rows} rows into other records, {len(merged_frame)} records remain.", True)
+    return merged_frame, merged_rows
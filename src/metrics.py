@@ -0,0 +1,187 @@
+import cProfile
+import os
+import pstats
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from json import dump
+from os import path, makedirs
+from time import perf_counter, time
+from src import logger
+
+# resource is not available on Windows, peak memory is not reported there
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# dynamically get path of script file and place reports next to it
+report_file_path = path.join(path.dirname(path.abspath(__file__)), "metrics.json")
+profile_folder = path.join(path.dirname(path.abspath(__file__)), "profile")
+# functions listed in the profile summary
+profile_function_count = 40
+# source lines listed in the memory summary
+profile_line_count = 25
+
+# measurements by stage name, stages that run more than once (e.g. for every chunk) are added up
+stages = {}
+# measurements by source file
+files = {}
+# row and byte counts of the whole run, e.g. rejected_values or merged_rows
+counters = {}
+run_start = perf_counter()
+profiler = None
+
+
+def reset():
+    global run_start
+    stages.clear()
+    files.clear()
+    counters.clear()
+    run_start = perf_counter()
+
+
+# highest memory use of this process so far, None if it can not be measured
+def get_peak_rss() -> int | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# processor time of this process and its finished worker processes
+def get_cpu_time() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+# measure wall time, processor time and peak memory of the code inside the with block
+# the block can set rows_in and rows_out of the yielded dict
+@contextmanager
+def stage(name, rows_in=0):
+    rows = {"rows_in": rows_in, "rows_out": None}
+    wall_start = perf_counter()
+    cpu_start = get_cpu_time()
+    try:
+        yield rows
+    finally:
+        record = stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "rows_in": 0, "rows_out": 0})
+        record["wall_seconds"] += perf_counter() - wall_start
+        record["cpu_seconds"] += get_cpu_time() - cpu_start
+        record["rows_in"] += rows["rows_in"]
+        record["rows_out"] += rows["rows_in"] if rows["rows_out"] is None else rows["rows_out"]
+        record["rows_per_second"] = record["rows_in"] / max(record["wall_seconds"], 1e-9)
+        record["peak_rss_bytes"] = get_peak_rss()
+
+
+# add values of a source file, e.g. record_file("a.csv", rows_in=10, rejected_values=2)
+def record_file(file, **values):
+    record = files.setdefault(file, {})
+    for name, value in values.items():
+        record[name] = record.get(name, 0) + value
+
+
+def count(name, amount=1):
+    counters[name] = counters.get(name, 0) + amount
+
+
+def get_report(success=True) -> dict:
+    for record in files.values():
+        if "seconds" in record:
+            record["rows_per_second"] = record.get("rows_in", 0) / max(record["seconds"], 1e-9)
+    return {
+        "success": success,
+        "end_time": time(),
+        "wall_seconds": perf_counter() - run_start,
+        "cpu_seconds": get_cpu_time(),
+        "peak_rss_bytes": get_peak_rss(),
+        "counters": counters,
+        "stages": stages,
+        "files": files,
+    }
+
+
+def save_report(report, report_path=None):
+    report_path = report_path or report_file_path
+    with open(report_path, 'w', encoding='utf-8') as f:
+        dump(report, f, indent=2)
+    logger.log(f"Metrics saved to {report_path}", False)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# write the report in the text format of Prometheus, e.g. for the textfile collector of the node exporter
+def save_prometheus(report, prometheus_path):
+    lines = []
+
+    def add_metric(name, description, samples):
+        lines.append(f"# HELP etl_{name} {description}")
+        lines.append(f"# TYPE etl_{name} gauge")
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ",".join(f"{key}=\"{escape_label(label)}\"" for key, label in labels.items())
+            lines.append(f"etl_{name}{{{label_text}}} {value}" if label_text else f"etl_{name} {value}")
+
+    add_metric("run_success", "1 if the last run succeeded, 0 otherwise.", [({}, int(report["success"]))])
+    add_metric("run_end_timestamp_seconds", "Time the last run ended.", [({}, report["end_time"])])
+    add_metric("run_wall_seconds", "Wall time of the last run.", [({}, report["wall_seconds"])])
+    add_metric("run_cpu_seconds", "Processor time of the last run.", [({}, report["cpu_seconds"])])
+    add_metric("run_peak_rss_bytes", "Peak resident memory of the last run.", [({}, report["peak_rss_bytes"])])
+    for name, value in sorted(report["counters"].items()):
+        add_metric(name, f"{name.replace('_', ' ').capitalize()} of the last run.", [({}, value)])
+    stage_fields = {
+        "wall_seconds": "Wall time of each stage.",
+        "cpu_seconds": "Processor time of each stage.",
+        "peak_rss_bytes": "Peak resident memory at the end of each stage.",
+        "rows_in": "Rows going into each stage.",
+        "rows_out": "Rows coming out of each stage.",
+        "rows_per_second": "Rows processed per second by each stage.",
+    }
+    for field, description in stage_fields.items():
+        add_metric(f"stage_{field}", description,
+                   [({"stage": name}, record.get(field)) for name, record in report["stages"].items()])
+    file_fields = sorted({field for record in report["files"].values() for field in record})
+    for field in file_fields:
+        add_metric(f"file_{field}", f"{field.replace('_', ' ').capitalize()} of each source file.",
+                   [({"file": name}, record.get(field)) for name, record in report["files"].items()])
+
+    # write to a temporary file first, so the collector never reads a half written file
+    temporary_path = f"{prometheus_path}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary_path, prometheus_path)
+    logger.log(f"Prometheus metrics saved to {prometheus_path}", False)
+
+
+# profile calls and memory allocations of this process until stop_profiling is called
+def start_profiling():
+    global profiler
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+
+# save the profile to the profile folder: profile.prof for tools like snakeviz, profile.txt with the functions taking
+# the most time, and memory.txt with the source lines allocating the most memory
+def stop_profiling(folder=None):
+    global profiler
+    if profiler is None:
+        return
+    profiler.disable()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    folder = folder or profile_folder
+    makedirs(folder, exist_ok=True)
+    profiler.dump_stats(path.join(folder, "profile.prof"))
+    with open(path.join(folder, "profile.txt"), 'w', encoding='utf-8') as f:
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(profile_function_count)
+    with open(path.join(folder, "memory.txt"), 'w', encoding='utf-8') as f:
+        for statistic in snapshot.statistics("lineno")[:profile_line_count]:
+            f.write(f"{statistic}\n")
+    profiler = None
+    logger.log(f"Profile saved to {folder}", True)
@@ -0,0 +1,86 @@
+import re
+from dataclasses import dataclass, field
+from numpy import append
+from pandas import Series, factorize
+
+# built-in normalizers, a format file can add spellings or declare further normalizers in the same form
+# 'values' maps each output to the spellings it replaces (compared in lower case), 'default' replaces all other values
+# 'pattern' keeps values matching the whole regular expression, all others are omitted
+default_definitions = {
+    "bool": {"values": {"1": ["true", "1", "yes", "y", "ja", "j"]}, "default": "0"},
+    "gender": {"values": {"M": ["m", "male", "männlich", "maennlich"], "F": ["f", "female", "weiblich", "w"]},
+               "default": "X"},
+    "mail": {"pattern": r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+"},
+}
+# outputs a bool normalizer may produce, they are stored as true and false
+bool_outputs = ["1", "0"]
+
+
+@dataclass(frozen=True)
+class Normalizer:
+    name: str
+    # lower case spelling > output
+    mapping: dict[str, str | None] = field(default_factory=dict)
+    default: str | None = None
+    pattern: re.Pattern | None = None
+
+    # normalize a single value, for the row by row transformation
+    def normalize(self, value):
+        if self.pattern is not None:
+            return value if self.pattern.fullmatch(str(value)) else None
+        return self.mapping.get(str(value).lower(), self.default)
+
+
+def compile_normalizer(name, definition, errors) -> Normalizer | None:
+    if not isinstance(definition, dict) or ("values" in definition) == ("pattern" in definition):
+        errors.append(f"Normalizer {name} needs either 'values' or 'pattern'.")
+        return None
+
+    if "pattern" in definition:
+        try:
+            return Normalizer(name, pattern=re.compile(definition["pattern"]))
+        except (re.error, TypeError) as e:
+            errors.append(f"Invalid pattern for normalizer {name}: {e}")
+            return None
+
+    mapping = {}
+    for output, spellings in definition["values"].items():
+        if name == "bool" and output not in bool_outputs:
+            errors.append(f"Normalizer bool can only map to {' or '.join(bool_outputs)}, not '{output}'.")
+        for spelling in spellings if isinstance(spellings, list) else [spellings]:
+            mapping[str(spelling).lower()] = output
+    default = definition.get("default")
+    if name == "bool" and default not in bool_outputs + [None]:
+        errors.append(f"Normalizer bool can only map to {' or '.join(bool_outputs)}, not '{default}'.")
+    return Normalizer(name, mapping, default)
+
+
+# built-in normalizers extended by the ones of the format file
+# spellings are added to the built-in ones, a default or pattern replaces the built-in one
+def compile_normalizers(definitions, errors) -> dict[str, Normalizer]:
+    merged = {name: dict(definition) for name, definition in default_definitions.items()}
+    for name, definition in (definitions or {}).items():
+        if name in merged and isinstance(definition, dict) and "values" in definition and "values" in merged[name]:
+            values = {output: list(spellings) for output, spellings in merged[name]["values"].items()}
+            for output, spellings in definition["values"].items():
+                values.setdefault(output, []).extend(spellings if isinstance(spellings, list) else [spellings])
+            merged[name] = {**merged[name], **definition, "values": values}
+        else:
+            merged[name] = definition
+    normalizers = {name: compile_normalizer(name, definition, errors) for name, definition in merged.items()}
+    return {name: normalizer for name, normalizer in normalizers.items() if normalizer is not None}
+
+
+# normalize a whole column, every distinct value is only normalized once
+def normalize_column(values: Series, normalizer: Normalizer) -> Series:
+    codes, uniques = factorize(values)
+    text = Series(uniques, dtype=object).astype(str)
+    if normalizer.pattern is not None:
+        valid = text.str.fullmatch(normalizer.pattern).fillna(False).astype(bool)
+        normalized = Series(uniques, dtype=object).where(valid, None)
+    else:
+        lowered = text.str.lower()
+        unmatched = ~lowered.isin(normalizer.mapping.keys())
+        normalized = lowered.map(normalizer.mapping).astype(object).mask(unmatched, normalizer.default)
+    # code -1 marks missing values and picks the appended None
+    return Series(append(normalized.to_numpy(dtype=object), None)[codes], index=values.index, dtype=object)
@@ -0,0 +1,170 @@
+import re
+from dataclasses import replace
+from difflib import SequenceMatcher
+from hashlib import sha256
+from json import load, dump, dumps
+from os import path, makedirs
+from pandas import DataFrame, Series
+from pandas.api.types import is_bool_dtype, is_object_dtype
+from src import logger, extractor
+from src.format_plan import FormatPlan, TargetColumn, cache_folder, compile_rule, date_types
+from src.normalizers import normalize_column
+
+# inferred schemas are cached by the hash of the format file and the columns of the source file
+schema_folder = path.join(cache_folder, "schemas")
+# rows read from a file to infer its data types
+sample_rows = 1000
+# share of the sampled values that have to fit a data type for the column to get it
+type_share = 0.95
+# lowest score of a proposed mapping, between 0 and 1
+min_mapping_score = 0.6
+# data types tried in this order, columns fitting none of them are text
+# days come before months, so dates like 01.02.2000 are read as the first of February
+inference_types = ["int", "float"] + date_types + ["bool"]
+
+
+# 'Mitglieds-Nr' > 'mitgliedsnr'
+def normalize_name(name) -> str:
+    return re.sub(r"[^a-z0-9]", "", str(name).lower())
+
+
+def name_similarity(name, other_name) -> float:
+    return SequenceMatcher(None, normalize_name(name), normalize_name(other_name)).ratio()
+
+
+# most specific data type most sampled values fit, e.g. 'datetime_DMY_.' for '21.06.1966'
+def infer_type(values: Series) -> str:
+    present = values.dropna()
+    if present.empty:
+        return "str"
+    if is_bool_dtype(present):
+        return "bool"
+    for candidate in inference_types:
+        # only text can hold dates, numbers would be parsed as something else
+        if candidate in date_types and not is_object_dtype(present):
+            continue
+        converted = extractor.convert_column(present, candidate)
+        if converted.notna().mean() >= type_share:
+            return candidate
+    return "str"
+
+
+# share of the values the normalizer of the target recognizes, e.g. 'weiblich' for gender
+def value_similarity(values: Series, target: TargetColumn) -> float:
+    present = values.dropna()
+    if target.normalizer is None or present.empty:
+        return 0.0
+    if target.normalizer.pattern is not None:
+        return normalize_column(present, target.normalizer).notna().mean()
+    return present.astype(str).str.strip().str.lower().isin(target.normalizer.mapping.keys()).mean()
+
+
+# mapping of the best fitting target column or known source column, and its score
+# target columns are compared by name and values, known source columns by name and lend their mapping, e.g. §DISCARD
+def propose_mapping(column, column_type, values: Series, plan: FormatPlan) -> tuple[str | None, float]:
+    candidates = [(name, max(name_similarity(column, name), value_similarity(values, target)))
+                  for name, target in plan.targets.items()]
+    candidates += [(mapping, name_similarity(column, source)) for source, mapping in plan.column_mapping.items()]
+    for mapping, score in sorted(candidates, key=lambda candidate: -candidate[1]):
+        if score < min_mapping_score:
+            break
+        # the mapping has to fit the inferred data type
+        errors = []
+        compile_rule(column, mapping, {column: column_type}, plan.targets, errors)
+        if not errors:
+            return mapping, score
+    return None, 0.0
+
+
+def read_sample(file_path) -> DataFrame:
+    chunks = extractor.readers[extractor.get_extension(file_path)][1](file_path, sample_rows)
+    # the csv reader keeps the file open until it is closed
+    if hasattr(chunks, "__enter__"):
+        with chunks:
+            return next(iter(chunks), DataFrame())
+    return next(iter(chunks), DataFrame())
+
+
+# infer data types and mappings of the columns of a file that are not in the format file
+def infer_schema(file, sample: DataFrame, plan: FormatPlan) -> dict:
+    schema = {"file": file, "column_types": {}, "column_mapping": {}, "scores": {}, "unmapped": {}}
+    for column in sample.columns:
+        if column in plan.column_types:
+            continue
+        column_type = infer_type(sample[column])
+        mapping, score = propose_mapping(column, column_type, sample[column], plan)
+        if mapping is None:
+            schema["unmapped"][column] = column_type
+            continue
+        schema["column_types"][column] = column_type
+        schema["column_mapping"][column] = mapping
+        schema["scores"][column] = round(score, 2)
+    return schema
+
+
+# schema of the file, inferred once per layout of columns and then read from the cache
+def get_schema(folder, file, plan: FormatPlan) -> dict:
+    sample = read_sample(path.join(folder, file))
+    columns = [str(column) for column in sample.columns]
+    layout_hash = sha256("\n".join([plan.fingerprint, extractor.get_extension(file)] + columns).encode('utf-8'))
+    schema_path = path.join(schema_folder, f"schema_{layout_hash.hexdigest()}.json")
+    if path.exists(schema_path):
+        try:
+            with open(schema_path, 'r', encoding='utf-8') as f:
+                schema = load(f)
+            logger.log(f"Using schema of file {file} from cache {schema_path}", False)
+            return schema
+        except (OSError, ValueError) as e:
+            logger.log(f"Could not load schema from cache {schema_path}: {e}", False, logger.WARNING)
+
+    logger.log(f"Inferring schema of file {file}...", True)
+    schema = infer_schema(file, sample, plan)
+    for column, mapping in schema["column_mapping"].items():
+        logger.log(f"Column {column} of file {file} looks like {schema['column_types'][column]} and is mapped to "
+                   f"'{mapping}' (score {schema['scores'][column]}).", True)
+    for column, column_type in schema["unmapped"].items():
+        logger.log(f"Column {column} of file {file} looks like {column_type} but fits no target column.", True)
+
+    try:
+        makedirs(schema_folder, exist_ok=True)
+        with open(schema_path, 'w', encoding='utf-8') as f:
+            dump(schema, f, indent=2, ensure_ascii=False)
+        if schema["column_mapping"]:
+            logger.log(f"The proposed column_types and column_mapping are saved in {schema_path} and can be copied "
+                       f"into the format file.", True)
+    except OSError as e:
+        logger.log(f"Could not cache schema to {schema_path}: {e}", False, logger.WARNING)
+    return schema
+
+
+# plan extended by the inferred columns of all files in the folder, columns of the format file are kept as they are
+# if files disagree about a column, the first file in processing order wins
+def extend_plan(plan: FormatPlan, folder) -> FormatPlan:
+    column_types = dict(plan.column_types)
+    column_mapping = dict(plan.column_mapping)
+    for file in extractor.list_source_files(folder):
+        try:
+            schema = get_schema(folder, file, plan)
+        except Exception as e:
+            logger.log(f"Could not infer schema of file {file}: {e}", True, logger.WARNING)
+            continue
+        for column, mapping in schema["column_mapping"].items():
+            if column not in column_types:
+                column_types[column] = schema["column_types"][column]
+                column_mapping[column] = mapping
+
+    added = {column: (column_types[column], column_mapping[column])
+             for column in column_mapping if column not in plan.column_mapping}
+    if not added:
+        return plan
+    errors = []
+    rules = dict(plan.rules)
+    for column in added:
+        rules[column] = compile_rule(column, column_mapping[column], column_types, plan.targets, errors)
+    if errors:
+        raise ValueError("Invalid inferred schema:\n" + "\n".join(errors))
+    # results cached by the fingerprint, e.g. of --incremental, depend on the added columns
+    fingerprint = sha256((plan.fingerprint + dumps(added, sort_keys=True)).encode('utf-8')).hexdigest()
+    logger.log(f"Added {len(added)} inferred columns to the format.", True)
+    return replace(plan, column_types=column_types, column_mapping=column_mapping, rules=rules,
+                   fingerprint=fingerprint)
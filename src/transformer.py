@@ -1,6 +1,19 @@
-from re import match
-from pandas import isnull, DataFrame, Timestamp, to_datetime
-from src import logger
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pandas import isnull, DataFrame, Series, Timestamp, concat, to_datetime
+from pandas.api.types import is_datetime64_any_dtype
+from src import logger, constraints, dates, dtypes, metrics
+from src.constraints import Constraint
+from src.dates import date_formats, output_date_format, get_reference_date, parse_dates, format_dates, calc_age, \
+    calc_birthdate
+from src.format_plan import FormatPlan, Rule, TargetColumn, date_types
+from src.normalizers import normalize_column
+
+# rows each worker process transforms at once, inputs with fewer rows are transformed in this process
+default_partition_size = 100_000
+
+# plan of a worker process, set once when the process starts instead of being sent with every partition
+worker_plan = None
 
 
 def calc(value, calc_type):
@@ -9,9 +22,9 @@ def calc(value, calc_type):
 
     if calc_type == "AGE":
         try:
-            # parse the date string to a datetime object
-            date_value = to_datetime(value, format="dd-mm-YYYY")
-            today = Timestamp.today()
+            # parse the date string to a datetime object, dates are formatted during preprocessing
+            date_value = to_datetime(value, format=output_date_format)
+            today = get_reference_date()
             # calculate the age based on the date
             age = today.year - date_value.year - ((today.month, today.day) < (date_value.month, date_value.day))
             return age
@@ -21,10 +34,10 @@ def calc(value, calc_type):
     elif calc_type == "BIRTHDATE":
         try:
             # calculate the date of birth assuming today is the birthday
-            today = Timestamp.today()
+            today = get_reference_date()
             birthday_year = today.year - int(value)
             birth_date = Timestamp(year=birthday_year, month=today.month, day=today.day)
-            return birth_date.strftime("%d-%m-%Y")
+            return birth_date.strftime(output_date_format)
         except Exception as e:
             logger.log(f"Error calculating BIRTHDAY for age '{value}': {e}", True)
             return None
@@ -35,146 +48,231 @@ def calc(value, calc_type):
 def format_date(value, source_format, source_separator):
     if isnull(value):
         return None
+    if (source_format, source_separator) not in date_formats:
+        return value
 
     try:
-        if source_format == "DMY" and source_separator == "-":
-            return to_datetime(value, format="%d-%m-%Y").strftime("%d-%m-%Y")
-        elif source_format == "DMY" and source_separator == ".":
-            return to_datetime(value, format="%d.%m.%Y").strftime("%d-%m-%Y")
-        elif source_format == "MDY" and source_separator == "-":
-            return to_datetime(value, format="%m-%d-%Y").strftime("%d-%m-%Y")
-        elif source_format == "MDY" and source_separator == ".":
-            return to_datetime(value, format="%m.%d.%Y").strftime("%d-%m-%Y")
-        elif source_format == "YMD" and source_separator == "-":
-            return to_datetime(value, format="%Y-%m-%d").strftime("%d-%m-%Y")
-        elif source_format == "YMD" and source_separator == ".":
-            return to_datetime(value, format="%Y.%m.%d").strftime("%d-%m-%Y")
-        else:
-            return value
+        # values are usually parsed during validation already
+        if not isinstance(value, Timestamp):
+            value = to_datetime(value, format=date_formats[(source_format, source_separator)])
+        return value.strftime(output_date_format)
     except Exception as e:
         logger.log(
             f"Error formatting date '{value}' with source format '{source_format}' and separator '{source_separator}': {e}",
-            False)
+            False, logger.DEBUG)
         return None
 
 
-def preprocess_value(value, column_name, column_mapping, column_types):
+def preprocess_value(value, rule: Rule):
     # if value is date, ensure uniform format is used
-    if column_types[column_name].startswith("datetime_"):
-        logger.log(f"Formatting date '{value}' in column {column_name}...", False)
-        return format_date(value, column_types[column_name].split("_")[1], column_types[column_name].split("_")[2])
+    if rule.date_format is not None:
+        if logger.is_enabled(logger.DEBUG):
+            logger.log(f"Formatting date '{value}' in column {rule.source}...", False, logger.DEBUG)
+        return format_date(value, rule.date_format[0], rule.date_format[1])
     return value
 
 
-def postprocess_value(value, column_name, target_column_name, column_mapping, column_types, target_column_types: dict[str, str]):
-    # format bools as true = 1 and false = 0
-    if target_column_types[target_column_name].startswith("bool"):
-        value = value.lower()
-        if value == "true" or value == "1" or value == "yes" or value == "y" or value == "ja" or value == "j":
-            return "1"
-        else:
-            return "0"
-
-    # format gender as M, F or X
-    if target_column_types[target_column_name].startswith("gender"):
-        value = value.lower()
-        if value == "m" or value == "male" or value == "männlich" or value == "maennlich":
-            return "M"
-        elif value == "f" or value == "female" or value == "weiblich" or value == "w":
-            return "F"
-        else:
-            return "X"
-
-    # omit invalid mail addresses
-    if target_column_types[target_column_name].startswith("mail"):
-        email_pattern = r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$"
-        if not match(email_pattern, value):
-            return None
-
+def postprocess_value(value, target: TargetColumn):
+    # normalize bools to 1 and 0, gender to M, F or X, omit invalid mail addresses, and so on
+    if target.normalizer is not None:
+        return target.normalizer.normalize(value)
     return value
 
 
-def transform_step(frame, value, column_name, row_index, column_mapping, colum_types, target_column_types):
+def transform_step(frame, value, rule: Rule, row_index, targets: dict[str, TargetColumn]):
     if isnull(value):
         return
 
-    logger.log(f"Processing value '{value}' in column {column_name} at row {row_index}...", False)
+    # per value messages are only built if they are written
+    debug = logger.is_enabled(logger.DEBUG)
+    if debug:
+        logger.log(f"Processing value '{value}' in column {rule.source} at row {row_index}...", False, logger.DEBUG)
 
     # preprocess value
-    value = preprocess_value(value, column_name, column_mapping, colum_types)
+    value = preprocess_value(value, rule)
 
     # discard value
-    if column_mapping[column_name].startswith("§DISCARD"):
-        logger.log(f"Discarding value '{value}' in column {column_name} at row {row_index}...", False)
+    if rule.action == "DISCARD":
+        if debug:
+            logger.log(f"Discarding value '{value}' in column {rule.source} at row {row_index}...", False,
+                       logger.DEBUG)
         return
 
     # calculate specified calculation type
     # example: '§CALC§AGE§member_age'
-    elif column_mapping[column_name].startswith("§CALC"):
-        target_column_name = column_mapping[column_name].split("§")[3]
-        # get calculation type
-        calc_type = column_mapping[column_name].split("§")[2]
+    elif rule.action == "CALC":
+        target_column_name = rule.targets[0]
         # calculate value
-        logger.log(f"Calculating {calc_type} for value '{value}' in column {column_name} at row {row_index}...", False)
-        calculated_value = calc(value, calc_type)
-        calculated_value = postprocess_value(calculated_value, column_name, target_column_name, column_mapping,
-                                             colum_types, target_column_types)
+        if debug:
+            logger.log(f"Calculating {rule.argument} for value '{value}' in column {rule.source} at row {row_index}...",
+                       False, logger.DEBUG)
+        calculated_value = calc(value, rule.argument)
+        calculated_value = postprocess_value(calculated_value, targets[target_column_name])
         # insert in mapped column
         frame.at[row_index, target_column_name] = calculated_value
 
     # split value and insert into specified columns
     # example: '§SPLIT§ §first_name§last_name' - Leon Becker > first_name=Leon, last_name=Becker
-    elif column_mapping[column_name].startswith("§SPLIT"):
-        # get separator char
-        separator = column_mapping[column_name].split("§")[2]
+    elif rule.action == "SPLIT":
         # get split value
-        logger.log(f"Splitting value '{value}' in column {column_name} at row {row_index} with separator '{separator}'...", False)
-        values = value.split(separator)
+        if debug:
+            logger.log(f"Splitting value '{value}' in column {rule.source} at row {row_index} with separator '{rule.argument}'...",
+                       False, logger.DEBUG)
+        values = value.split(rule.argument)
         # insert into mapped columns
-        mapped_columns = column_mapping[column_name].split("§")[3:]
         for i, split_value in enumerate(values):
-            if i < len(mapped_columns):
-                target_column_name = mapped_columns[i]
-                frame.at[row_index, target_column_name] = postprocess_value(split_value, column_name,
-                                                                            target_column_name, column_mapping,
-                                                                            colum_types, target_column_types)
+            if i < len(rule.targets):
+                target_column_name = rule.targets[i]
+                frame.at[row_index, target_column_name] = postprocess_value(split_value,
+                                                                            targets[target_column_name])
 
     else:
         # insert value into mapped column
-        logger.log(f"Inserting value '{value}' in column {column_name} at row {row_index}...", False)
-        target_column_name = column_mapping[column_name]
-        frame.at[row_index, target_column_name] = postprocess_value(value, column_name, target_column_name,
-                                                                    column_mapping, colum_types, target_column_types)
+        if debug:
+            logger.log(f"Inserting value '{value}' in column {rule.source} at row {row_index}...", False, logger.DEBUG)
+        target_column_name = rule.targets[0]
+        frame.at[row_index, target_column_name] = postprocess_value(value, targets[target_column_name])
 
 
-def postprocess_frame(frame: DataFrame, target_frame_columns):
-    rows_to_drop = []
-    for index, row in frame.iterrows():
-        for column, value in row.items():
-            # if required values are missing, select the row to be dropped
-            if target_frame_columns[column].endswith("§REQUIRED"):
-                if not isnull(value):
-                    continue
-                logger.log(f"Discarding row {index} because column {column} is required but missing.", False)
-                rows_to_drop.append(index)
-                break
-    # drop selected rows
-    return frame.drop(rows_to_drop)
-
-
-def transform(frame, target_frame_columns, column_mapping, column_types) -> DataFrame:
-    logger.log("Transforming data into target format...", True)
-    # create a new DataFrame with columns in the specified order
-    transformed_frame = DataFrame(columns=target_frame_columns.keys())
+# drop rows violating the constraints of the target columns, e.g. missing required values
+# called after records were merged, so a partial record can still be completed by another source
+def postprocess_frame(frame: DataFrame, target_constraints: list[Constraint]) -> DataFrame:
+    with metrics.stage("constraints", len(frame)) as rows:
+        frame = constraints.apply_constraints(frame, target_constraints)
+        rows["rows_out"] = len(frame)
+    return frame
+
 
+def transform_rows(frame, plan: FormatPlan) -> DataFrame:
+    # legacy row-by-row path, kept to compare results against the column engine
+    transformed_frame = DataFrame(columns=plan.targets.keys())
+
+    rules = plan.rules_for(frame.columns)
     for index, row in frame.iterrows():
-        for column, value in row.items():
-            if column in column_mapping:  # Only process mapped columns
-                transform_step(transformed_frame, value, column, index, column_mapping, column_types,
-                               target_frame_columns)
+        for rule in rules:  # Only process mapped columns
+            transform_step(transformed_frame, row[rule.source], rule, index, plan.targets)
+
+    return transformed_frame
+
+
+# calculate on whole columns, dates are expected to be parsed already
+def calc_column(values: Series, calc_type) -> Series:
+    if calc_type == "AGE":
+        return calc_age(values)
+    elif calc_type == "BIRTHDATE":
+        return calc_birthdate(values)
+
+    return Series(None, index=values.index, dtype=object)
+
+
+def postprocess_column(values: Series, target: TargetColumn) -> Series:
+    # normalize bools to 1 and 0, gender to M, F or X, omit invalid mail addresses, and so on
+    if target.normalizer is not None:
+        return normalize_column(values, target.normalizer)
+    return values
+
+
+def transform_columns(frame, plan: FormatPlan) -> DataFrame:
+    transformed_frame = DataFrame(index=frame.index, columns=list(plan.targets.keys()), dtype=object)
+    # rows only appear in the result once any value has been written to them
+    written = Series(False, index=frame.index)
+
+    for rule in plan.rules_for(frame.columns):
+        column = rule.source
+        if rule.action == "DISCARD":
+            logger.log(f"Discarding column {column}...", False)
+            continue
+
+        values = frame[column]
+        present = values.notna()
+        if not present.any():
+            continue
+
+        # dates stay parsed, they are only formatted for text target columns
+        if rule.date_format is not None:
+            values = parse_dates(values, rule.date_format)
+
+        if rule.action == "CALC":
+            logger.log(f"Calculating {rule.argument} for column {column}...", False)
+            results = [(rule.targets[0], calc_column(values, rule.argument), present)]
+        elif rule.action == "SPLIT":
+            logger.log(f"Splitting column {column} with separator '{rule.argument}'...", False)
+            parts = values.str.split(rule.argument, expand=True, regex=False)
+            results = []
+            for i, target_column_name in enumerate(rule.targets):
+                if i in parts.columns:
+                    results.append((target_column_name, parts[i], present & parts[i].notna()))
+        else:
+            logger.log(f"Inserting column {column} into {rule.targets[0]}...", False)
+            results = [(rule.targets[0], values, present)]
+
+        # later columns overwrite earlier ones, like the row path does
+        for target_column_name, target_values, mask in results:
+            target = plan.targets[target_column_name]
+            if is_datetime64_any_dtype(target_values) and target.type not in date_types:
+                logger.log(f"Formatting dates for column {target_column_name}...", False)
+                target_values = format_dates(target_values)
+            # nullable numbers would become floats when mixed into the object column
+            target_values = postprocess_column(target_values, target).astype(object)
+            transformed_frame[target_column_name] = transformed_frame[target_column_name].mask(mask, target_values)
+        written |= present
+
+    return transformed_frame[written]
+
+
+# runs in every worker process before its first partition
+# processes that are not forked do not inherit the log level
+def set_worker_plan(plan: FormatPlan, log_level=logger.INFO):
+    global worker_plan
+    worker_plan = plan
+    logger.set_level(log_level)
+
+
+# dates are calculated from the same day as in the main process, which can change while a pool is kept, e.g. by --watch
+def transform_partition(partition, legacy, reference_date) -> DataFrame:
+    dates.reference_date = reference_date
+    try:
+        if legacy:
+            return transform_rows(partition, worker_plan)
+        return transform_columns(partition, worker_plan)
+    finally:
+        # worker processes end without writing what is left in the log buffer
+        logger.flush()
+
+
+# transform consecutive partitions of the frame in worker processes and combine them in the original order
+# an executor kept between calls has to be started with set_worker_plan for the same plan, otherwise one is started
+def transform_partitions(frame, plan: FormatPlan, legacy, workers, partition_size, executor=None) -> DataFrame:
+    partitions = [frame.iloc[start:start + partition_size] for start in range(0, len(frame), partition_size)]
+    logger.log(f"Transforming {len(partitions)} partitions in {min(workers, len(partitions))} processes...", False)
+    # map returns the results in the order of the partitions
+    arguments = (transform_partition, partitions, repeat(legacy), repeat(dates.get_reference_date()))
+    if executor is not None:
+        return concat(list(executor.map(*arguments)))
+    with ProcessPoolExecutor(max_workers=min(workers, len(partitions)), initializer=set_worker_plan,
+                             initargs=(plan, logger.log_level)) as executor:
+        return concat(list(executor.map(*arguments)))
+
+
+# with more than one worker, frames larger than one partition are transformed in parallel
+# constraints are not checked yet, see postprocess_frame
+def transform(frame, plan: FormatPlan, legacy=False, workers=1, partition_size=default_partition_size,
+              executor=None) -> DataFrame:
+    logger.log("Transforming data into target format...", True)
+    with metrics.stage("transform", len(frame)) as rows:
+        # create a new DataFrame with columns in the specified order
+        if workers > 1 and len(frame) > partition_size:
+            transformed_frame = transform_partitions(frame, plan, legacy, workers, partition_size, executor)
+        elif legacy:
+            transformed_frame = transform_rows(frame, plan)
+        else:
+            transformed_frame = transform_columns(frame, plan)
+        rows["rows_out"] = len(transformed_frame)
 
     logger.log("Data transformed successfully.", True)
 
-    transformed_frame = postprocess_frame(transformed_frame, target_frame_columns)
+    with metrics.stage("postprocess", len(transformed_frame)):
+        # store every column in the most compact dtype of its target type, constraints compare typed values
+        transformed_frame = dtypes.apply_target_dtypes(transformed_frame, plan.targets)
 
     return transformed_frame
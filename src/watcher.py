@@ -0,0 +1,205 @@
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from os import path, listdir, makedirs, replace, stat
+from queue import Queue, Empty
+from threading import Event, Thread
+from time import strftime
+from pandas import concat
+from src import logger, dates, dtypes, extractor, loader, metrics, transformer, xml_reader
+from src.format_plan import FormatPlan
+
+# inotify reports finished files right away on Linux, other systems poll the folder
+try:
+    from inotify_simple import INotify, flags
+    inotify_available = True
+except ImportError:
+    inotify_available = False
+
+# seconds between two looks at the folder when polling, a file is queued once its size stayed the same for one interval
+poll_interval = 2.0
+# most files processed together, so a large backlog is loaded in several batches
+batch_file_count = 32
+# folders inside the watched folder that processed files are moved to
+archive_folder_name = "archive"
+quarantine_folder_name = "quarantine"
+
+# names of files waiting to be processed
+file_queue = Queue()
+# files that are queued or being processed, so they are not queued twice
+pending_files = set()
+# set to stop watching after the current batch
+stop_event = Event()
+
+
+def stop(*args):
+    stop_event.set()
+
+
+# runs in every worker process when it starts, Ctrl+C reaches the whole process group and is handled by the watcher only
+# the plan is sent once, the same processes read the files and transform the partitions of every batch
+def init_worker(plan: FormatPlan, row_path, log_level):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    xml_reader.set_row_path(row_path)
+    transformer.set_worker_plan(plan, log_level)
+
+
+def queue_file(file):
+    if file not in pending_files and extractor.get_extension(file) in extractor.readers:
+        pending_files.add(file)
+        file_queue.put(file)
+
+
+# queue files when they are closed after writing or moved into the folder
+def watch_inotify(folder):
+    inotify = INotify()
+    inotify.add_watch(folder, flags.CLOSE_WRITE | flags.MOVED_TO)
+    while not stop_event.is_set():
+        for event in inotify.read(timeout=int(poll_interval * 1000)):
+            if path.isfile(path.join(folder, event.name)):
+                queue_file(event.name)
+    inotify.close()
+
+
+# queue files whose size and modification time did not change since the last look, so half written files are skipped
+def watch_polling(folder):
+    last_seen = {}
+    while not stop_event.is_set():
+        seen = {}
+        for file in listdir(folder):
+            file_path = path.join(folder, file)
+            if file in pending_files or not path.isfile(file_path):
+                continue
+            try:
+                status = stat(file_path)
+            except FileNotFoundError:
+                continue
+            seen[file] = (status.st_size, status.st_mtime)
+            if last_seen.get(file) == seen[file]:
+                queue_file(file)
+        last_seen = seen
+        stop_event.wait(poll_interval)
+
+
+# move a processed file into the archive or quarantine folder, files of the same name get the time appended
+def move_file(folder, file, target_folder):
+    makedirs(target_folder, exist_ok=True)
+    target_path = path.join(target_folder, file)
+    if path.exists(target_path):
+        name, extension = path.splitext(file)
+        target_path = path.join(target_folder, f"{name}_{strftime('%Y%m%d%H%M%S')}{extension}")
+    try:
+        replace(path.join(folder, file), target_path)
+    except OSError as e:
+        logger.log(f"Could not move file {file} to {target_folder}: {e}", True, logger.ERROR)
+    pending_files.discard(file)
+
+
+# wait for the next file, then take all files queued so far up to batch_file_count
+def get_batch() -> list[str]:
+    try:
+        files = [file_queue.get(timeout=poll_interval)]
+    except Empty:
+        return []
+    while len(files) < batch_file_count:
+        try:
+            files.append(file_queue.get_nowait())
+        except Empty:
+            break
+    return files
+
+
+# extract, transform and append the files of one batch to the target, given as format, path and database options
+# return the files that were saved and the files that could not be read
+def process_batch(folder, files, plan: FormatPlan, executor, stream_target, on_error, legacy, workers,
+                  partition_size) -> tuple[list[str], list[str]]:
+    target, target_path, sql_options = stream_target
+    logger.log(f"Processing {len(files)} new files...", True)
+    with metrics.stage("extract") as rows:
+        if executor is not None:
+            results = list(executor.map(extractor.extract_file, repeat(folder), files, repeat(plan.read_column_types),
+                                        repeat(on_error)))
+        else:
+            results = [extractor.extract_file(folder, file, plan.read_column_types, on_error) for file in files]
+        for file, (df, source_rows, source_bytes, rejects, seconds) in zip(files, results):
+            extractor.save_rejects(rejects)
+            extractor.record_file_metrics(file, df, source_rows, source_bytes, rejects, seconds)
+        rows["rows_in"] = sum(result[1] for result in results)
+        frames = [result[0] for result in results if result[0] is not None]
+        rows["rows_out"] = sum(len(df) for df in frames)
+
+    failed_files = [file for file, result in zip(files, results) if result[0] is None]
+    read_files = [file for file, result in zip(files, results) if result[0] is not None]
+    if not frames:
+        return [], failed_files
+
+    frame = dtypes.apply_source_dtypes(concat(frames, ignore_index=True), plan.read_column_types)
+    transformed_frame = transformer.transform(frame, plan, legacy, workers, partition_size, executor)
+    transformed_frame = transformer.postprocess_frame(transformed_frame, plan.constraints)
+    # an existing target file is continued, e.g. after the watcher was restarted
+    first_chunk = target != "sql" and (not path.exists(target_path) or path.getsize(target_path) == 0)
+    loader.save_chunk(transformed_frame, target, target_path, sql_options, first_chunk)
+    metrics.count("source_rows", sum(result[1] for result in results))
+    metrics.count("source_bytes", sum(result[2] for result in results))
+    metrics.count("target_rows", len(transformed_frame))
+    logger.log(f"Saved {len(transformed_frame)} rows of {len(read_files)} files.", True)
+    return read_files, failed_files
+
+
+# process files arriving in the folder until stopped with Ctrl+C or SIGTERM
+# the compiled plan, the worker processes and database connections are kept between batches
+# after_batch is called after every batch, e.g. to save the metrics
+def watch(folder, plan: FormatPlan, stream_target, on_error="null", legacy=False, workers=1,
+          partition_size=transformer.default_partition_size, archive_folder=None, quarantine_folder=None,
+          after_batch=None):
+    archive_folder = archive_folder or path.join(folder, archive_folder_name)
+    quarantine_folder = quarantine_folder or path.join(folder, quarantine_folder_name)
+    stop_event.clear()
+    # Ctrl+C only stops after the current batch, so no batch is saved without its files being moved
+    previous_handlers = {signal_number: signal.signal(signal_number, stop)
+                         for signal_number in (signal.SIGINT, signal.SIGTERM)}
+    extractor.init_rejects()
+    # files that arrived while nothing was watching
+    for file in extractor.list_source_files(folder):
+        queue_file(file)
+
+    watch_folder = watch_inotify if inotify_available else watch_polling
+    watcher_thread = Thread(target=watch_folder, args=(folder,), name="folder-watcher", daemon=True)
+    watcher_thread.start()
+    logger.log(f"Watching {folder} for new files{'' if inotify_available else ' by polling'}, "
+               "press Ctrl+C to stop...", True)
+
+    # processes that are not forked do not inherit the row path and log level
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                   initargs=(plan, xml_reader.row_path, logger.log_level)) if workers > 1 else None
+    try:
+        while not stop_event.is_set():
+            files = get_batch()
+            if not files:
+                continue
+            # ages and birthdates are calculated from the day of the batch, not the day the watcher started
+            dates.reference_date = None
+            try:
+                saved_files, failed_files = process_batch(folder, files, plan, executor, stream_target, on_error,
+                                                           legacy, workers, partition_size)
+            except Exception as e:
+                logger.log(f"Could not process files {', '.join(files)}: {e}", True, logger.ERROR)
+                saved_files, failed_files = [], files
+            for file in saved_files:
+                move_file(folder, file, archive_folder)
+            for file in failed_files:
+                move_file(folder, file, quarantine_folder)
+            metrics.count("archived_files", len(saved_files))
+            metrics.count("quarantined_files", len(failed_files))
+            if after_batch is not None:
+                after_batch()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        if executor is not None:
+            executor.shutdown()
+        watcher_thread.join()
+        for signal_number, handler in previous_handlers.items():
+            signal.signal(signal_number, handler)
+        logger.log("Stopped watching.", True)
@@ -0,0 +1,158 @@
+from pandas import DataFrame, RangeIndex, concat
+
+# lxml can skip every element that is not a row, the standard library parser is used if it is not installed
+try:
+    from lxml.etree import iterparse
+    lxml_available = True
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+    lxml_available = False
+
+# path of the row elements, e.g. 'mitglied', 'vereinsverwaltung/mitglied' or '/export/members/member'
+# a path starting with '/' is matched from the root element, any other path at any depth
+# None takes the children of the root element named like the first one as rows
+row_path = None
+
+
+def set_row_path(path):
+    global row_path
+    row_path = path
+
+
+# split a row path into its element names, and whether it has to match from the root
+def parse_row_path(path) -> tuple[list[str], bool]:
+    # the children of the root element named like the first one
+    if path is None:
+        return [], True
+    absolute = path.startswith("/") and not path.startswith("//")
+    return [part for part in path.strip("/").split("/") if part], absolute
+
+
+# element name without namespace, '{http://example.com}mitglied' > 'mitglied'
+def local_name(tag) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+# names of the root element and its first child, an empty list if the root has no children
+def get_first_row_path(file_path) -> list[str]:
+    names = []
+    # iterparse only closes files it opened itself once it reached the end
+    with open(file_path, 'rb') as f:
+        for event, element in iterparse(f, events=("start", "end")):
+            if event == "end":
+                return []
+            names.append(local_name(element.tag))
+            if len(names) == 2:
+                return names
+    return []
+
+
+# True if the names of the element and its ancestors end with the names of the path
+def matches_path(element, parts, absolute) -> bool:
+    for part in reversed(parts[:-1]):
+        element = element.getparent()
+        if element is None or local_name(element.tag) != part:
+            return False
+    return not absolute or element.getparent() is None
+
+
+# yield row elements using the tag filter of lxml, so only rows are turned into python objects
+def iterate_rows_lxml(file_path, parts, absolute):
+    for event, element in iterparse(file_path, events=("end",), tag=f"{{*}}{parts[-1]}"):
+        parent = element.getparent()
+        if matches_path(element, parts, absolute):
+            yield element
+        # free parsed rows, their parent would otherwise keep them alive
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+# yield row elements by tracking the open elements, for parsers without a tag filter
+def iterate_rows_etree(file_path, parts, absolute):
+    open_names = []
+    open_elements = []
+    for event, element in iterparse(file_path, events=("start", "end")):
+        if event == "start":
+            open_names.append(local_name(element.tag))
+            open_elements.append(element)
+            continue
+
+        if absolute:
+            row = open_names == parts
+        else:
+            row = open_names[-len(parts):] == parts
+        open_names.pop()
+        open_elements.pop()
+        if not row:
+            continue
+
+        yield element
+        # a row that just ended is always the last child of its parent
+        if open_elements:
+            del open_elements[-1][-1]
+        else:
+            element.clear()
+
+
+# rows with the same child elements are collected together, so each group becomes a frame in one step
+def build_frame(layouts: dict[tuple, tuple[list, list]], offset, rows) -> DataFrame:
+    frames = []
+    for names, (positions, records) in layouts.items():
+        # keep the first value of repeated child elements
+        columns = {}
+        for i, name in enumerate(names):
+            if isinstance(name, str):
+                columns.setdefault(local_name(name), i)
+        frame = DataFrame(records, columns=list(range(len(names))), index=positions, dtype=object)
+        frames.append(frame[list(columns.values())].set_axis(list(columns.keys()), axis=1))
+    if not frames:
+        return DataFrame(index=RangeIndex(offset, offset + rows))
+    frame = frames[0] if len(frames) == 1 else concat(frames).sort_index()
+    return frame.set_axis(RangeIndex(offset, offset + rows))
+
+
+# yield the rows of a xml file in frames of chunk_size rows, or all rows in one frame if chunk_size is None
+# attributes and child elements of a row element become its columns, every value is read as text
+# parsed rows are removed from the document right away, so memory use does not grow with the size of the file
+# with columns, only child elements and attributes of these names are kept
+def read_rows(file_path, chunk_size=None, path=None, columns=None):
+    parts, absolute = parse_row_path(row_path if path is None else path)
+    if not parts:
+        parts = get_first_row_path(file_path)
+    iterate_rows = iterate_rows_lxml if lxml_available else iterate_rows_etree
+    layouts = {}
+    offset = 0
+    rows = 0
+    for element in iterate_rows(file_path, parts, absolute) if parts else []:
+        children = list(element)
+        if columns is not None:
+            # comments and processing instructions have no name and are skipped, like in build_frame
+            children = [child for child in children if isinstance(child.tag, str) and local_name(child.tag) in columns]
+        names = tuple([child.tag for child in children])
+        values = [child.text for child in children]
+        if element.attrib:
+            attributes = {name: value for name, value in element.attrib.items()
+                          if columns is None or local_name(name) in columns}
+            names += tuple(attributes.keys())
+            values += attributes.values()
+        positions, records = layouts.setdefault(names, ([], []))
+        positions.append(rows)
+        records.append(values)
+        rows += 1
+
+        if rows == chunk_size:
+            yield build_frame(layouts, offset, rows)
+            offset += rows
+            rows = 0
+            layouts = {}
+    if rows or offset == 0:
+        yield build_frame(layouts, offset, rows)
+
+
+def read_xml_file(file_path, column_types=None) -> DataFrame:
+    return next(read_rows(file_path, columns=column_types))
+
+
+def read_xml_chunks(file_path, chunk_size, column_types=None):
+    return read_rows(file_path, chunk_size, columns=column_types)